@@ -1,7 +1,11 @@
-import json
-import regex
+import orjson
+import simdjson
 from enum import Enum
 
+# Reusable lazy parser for peeking into the first market update without
+# materializing the full document as Python dicts
+_PEEK_PARSER = simdjson.Parser()
+
 
 def is_market_file(file_key: str) -> bool:
     """
@@ -24,34 +28,60 @@ def is_market_file(file_key: str) -> bool:
     False
     """
 
-    file_name = file_key.split("/")[-1]
-    return file_name.startswith("1.")
+    # startswith with a start offset avoids materializing the path segments
+    # (or even a file name substring) for every S3 key
+    return file_key.startswith("1.", file_key.rfind("/") + 1)
 
 
-def json_load_updates(string_updates: list[str]) -> list[dict]:
+def json_load_updates(string_updates) -> list[dict]:
     """
-    Parses a list of market update strings in JSON format into a list of dictionaries.
-    
-    Each string in the input list represents a single market update. This function parses
-    each of these strings into a Python dictionary and aggregates them into a list.
-    
+    Parses an iterable of market update lines in JSON format into a list of dictionaries.
+
+    Each line in the input represents a single market update. This function parses
+    each of these lines into a Python dictionary and aggregates them into a list. Parsing
+    is done with orjson, which is significantly faster than the stdlib json module and
+    accepts the raw UTF-8 bytes coming out of the bz2 decompression directly, so no
+    intermediate decode pass is needed. Accepting any iterable (eg. S3.stream_lines)
+    means only the parsed dicts are held in memory, never the raw file.
+
     Parameters:
-    - string_updates (list[str]): A list of market updates in JSON string format.
-    
+    - string_updates (Iterable[bytes]): Market updates in JSON format, one update per line.
+
     Returns:
     - list[dict]: A list of dictionaries, each representing a market update.
-    
+
     Example:
-    >>> json_load_updates(['{"mc": [{"id": "1.234"}]}', '{"mc": [{"id": "1.235"}]}'])
+    >>> json_load_updates([b'{"mc": [{"id": "1.234"}]}', b'{"mc": [{"id": "1.235"}]}'])
     >>> [{'mc': [{'id': '1.234'}]}, {'mc': [{'id': '1.235'}]}]
     """
 
-    marketdata = []
-    for line in string_updates:
-        update = json.loads(line)
-        marketdata.append(update)
-    
-    return marketdata
+    return [orjson.loads(line) for line in string_updates]
+
+
+def peek_market_definition(first_line: bytes) -> dict:
+    """
+    Extracts the market definition from the first raw market update line without
+    parsing it into a full Python dictionary.
+
+    The first Betfair update of a market file always carries the market definition,
+    and the filters in `is_matching_filters` only need a couple of its fields. Using
+    simdjson's lazy parser keeps the tokenized document in C and only materializes
+    the marketDefinition sub-document, so markets that fail the filters never pay
+    for a full parse of the file.
+
+    Parameters:
+    - first_line (bytes): The first market update line of a market file.
+
+    Returns:
+    - dict: A dictionary containing the market definition.
+
+    Example:
+    >>> peek_market_definition(b'{"mc": [{"marketDefinition": {"marketType": "WIN"}}]}')
+    >>> {'marketType': 'WIN'}
+    """
+
+    document = _PEEK_PARSER.parse(first_line)
+    return document.at_pointer("/mc/0/marketDefinition").as_dict()
 
 
 def get_market_definition(marketdata: list[dict]) -> dict:
@@ -82,30 +112,41 @@ def is_matching_filters(market_definition: dict, market_filter: Enum, country_fi
     
     The function checks if the market type and country code within the market definition match
     the specified market and country filters. Filters are provided as Enums, with their `value`
-    attribute containing the regular expression to match against.
-    
+    attribute containing the compiled regular expression to match against. Compiling the
+    patterns once at Enum construction avoids the per-call pattern lookup that
+    `regex.search(pattern_string, ...)` would do on every market.
+
     Parameters:
     - market_definition (dict): The market definition dictionary to check.
-    - market_filter (Enum): The Enum whose value is a regular expression for filtering market types.
-    - country_filter (Enum): The Enum whose value is a regular expression for filtering country codes.
-    
+    - market_filter (Enum): The Enum whose value is a compiled regular expression for filtering market types.
+    - country_filter (Enum): The Enum whose value is a compiled regular expression for filtering country codes.
+      Must carry an `is_match_all` attribute (set in the Enum's __init__, as in CountryFilters) marking
+      ".*" members, so match-all filters skip the regex search.
+
     Returns:
     - bool: True if the market matches both filters, False otherwise.
-    
+
     Example:
+    >>> import re
     >>> from enum import Enum
     >>> class MarketType(Enum):
-    ...     WIN = "WIN"
+    ...     WIN = re.compile("WIN")
     >>> class CountryCode(Enum):
-    ...     UK = "GB"
+    ...     UK = re.compile("GB")
+    ...     def __init__(self, pattern):
+    ...         self.is_match_all = pattern.pattern == r".*"
     >>> is_matching_filters({"marketType": "WIN", "countryCode": "GB"}, MarketType.WIN, CountryCode.UK)
     True
     """
 
+    # Check the country filter first: a two-character country code is cheaper to
+    # reject on than the longer market type, and match-all filters skip the
+    # regex search entirely.
     # There are edge cases where, for example, country code is not present
+    if not country_filter.is_match_all:
+        country_code = market_definition.get("countryCode", "")
+        if not country_filter.value.search(country_code):
+            return False
+
     market_type = market_definition.get("marketType", "")
-    country_code = market_definition.get("countryCode", "")
-    if regex.search(market_filter.value, market_type) and regex.search(country_filter.value, country_code):
-        return True
-    
-    return False
\ No newline at end of file
+    return bool(market_filter.value.search(market_type))
\ No newline at end of file
@@ -1,30 +1,22 @@
+import re
 from enum import Enum
 from metadata import HorseRacingMetadataBuilder, FootballMetadataBuilder, TennisMetadataBuilder
 
 class MarketFilters(Enum):
     # ^ - start of the string, $ - end of the string
-    FootballMarketRegex = r"(^MATCH_ODDS$)|(OVER)|(UNDER)|(_OU_)"
-    TennisMarketRegex = r"(^MATCH_ODDS$)"
-    HorseRacingMarketRegex = r"(^WIN$)|(^EACH_WAY$)"
+    # Patterns are compiled once at Enum construction so the hot
+    # is_matching_filters path can call .search() directly without a
+    # per-call pattern cache lookup
+    FootballMarketRegex = re.compile(r"(^MATCH_ODDS$)|(OVER)|(UNDER)|(_OU_)")
+    TennisMarketRegex = re.compile(r"(^MATCH_ODDS$)")
+    HorseRacingMarketRegex = re.compile(r"(^WIN$)|(^EACH_WAY$)")
 
     def __str__(self):
-        return self.value
-    
-    def __repr__(self):
-        return self.value
-    
-
-class MetaBuilder(Enum):
-    Football = FootballMetadataBuilder
-    Tennis = TennisMetadataBuilder
-    HorseRacing = HorseRacingMetadataBuilder
+        return self.value.pattern
 
-    def __str__(self):
-        return self.value
-    
     def __repr__(self):
-        return self.value
-    
+        return self.value.pattern
+
 
 class Sport(Enum):
     Football = "football"
@@ -33,22 +25,37 @@ class Sport(Enum):
 
     def __str__(self):
         return self.value
-    
+
     def __repr__(self):
         return self.value
-    
+
+
+# Plain mapping instead of an Enum: the values are classes, so the Enum
+# machinery added lookup overhead and its str-returning __str__/__repr__
+# crashed on class values anyway
+META_BUILDERS = {
+    Sport.Football: FootballMetadataBuilder,
+    Sport.Tennis: TennisMetadataBuilder,
+    Sport.HorseRacing: HorseRacingMetadataBuilder,
+}
+
 
 class CountryFilters(Enum):
-    FootballCountryRegex = r".*"
-    HorseRacingCountryRegex = r"(GB)|(IE)"
-    TennisCountryRegex = r".*"
+    FootballCountryRegex = re.compile(r".*")
+    HorseRacingCountryRegex = re.compile(r"(GB)|(IE)")
+    TennisCountryRegex = re.compile(r".*")
+
+    def __init__(self, pattern):
+        # A ".*" filter accepts every country, so the hot filter path can
+        # skip the regex search for these members entirely
+        self.is_match_all = pattern.pattern == r".*"
 
     def __str__(self):
-        return self.value
-    
+        return self.value.pattern
+
     def __repr__(self):
-        return self.value
-    
+        return self.value.pattern
+
 
 class Collections(Enum):
     Metadata = "metadata"
@@ -1,7 +1,8 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from operator import itemgetter
 from queries.query_utils import MarketType
-import copy
 import re
 
 # Milliseconds to minute constants
@@ -9,6 +10,38 @@ FIVE_MINUTES = 5 * 60 * 1000
 TEN_MINUTES = 10 * 60 * 1000
 ONE_SECOND = 1000
 
+
+def _parse_betfair_ts(value: str) -> datetime:
+    """
+    Parse a Betfair timestamp string ("%Y-%m-%dT%H:%M:%S.%fZ") into a naive
+    datetime. Stripping the trailing "Z" lets datetime.fromisoformat handle the
+    rest on its C fast path, which is considerably faster than strptime
+    re-interpreting the format string on every call.
+
+    Parameters:
+    - value (str): The timestamp string, eg. "2023-01-03T13:00:00.000Z".
+
+    Returns:
+    - datetime: The parsed (naive) datetime.
+    """
+
+    return datetime.fromisoformat(value[:-1])
+
+
+# Single-pass scan of a horse racing market name, compiled once at import.
+# Each alternative captures one of the three facts extracted from the name:
+# handicap marker, race type token and distance (eg. "2m4f")
+_RACE_NAME_RE = re.compile(r"(?P<hcap>Hcap|Handicap)|(?P<type>Hurdle|Hrd|Chase|Chs|INHF)|(?P<dist>\d+m\d*f|\d+m|\d+f)")
+
+# Map the raw race type token from the market name to its canonical form
+_RACE_TYPES = {
+    "Hrd": "Hurdle",
+    "Hurdle": "Hurdle",
+    "Chs": "Chase",
+    "Chase": "Chase",
+    "INHF": "NH Flat",
+}
+
 class MetadataBuilder:
     """
     A class to build metadata for market data, including pre-market and post-market ladders,
@@ -45,6 +78,11 @@ class MetadataBuilder:
         self.in_play_start: pd.Timestamp = in_play_start
         self.in_play_end: pd.Timestamp = in_play_end
 
+        # Millisecond epoch of the in-play start, computed once so the pre
+        # in-play window maths never goes through Timestamp arithmetic. None
+        # when the market never goes in-play.
+        self._in_play_start_ms: int = self.in_play_start.value // 1_000_000 if self.in_play_start is not None else None
+
         self.pre10ladder: dict = None
         self.pre5ladder: dict = None
         self.pre0ladder: dict = None
@@ -62,14 +100,19 @@ class MetadataBuilder:
         instead of strings, and the unique _id field for MongoDB. The metadata base
         returned will be extended as the market data is processed (ie. ladder is built)
 
+        Only the top-level dict and the marketDefinition sub-dict are mutated below,
+        so two shallow copies are enough to leave `mc` untouched. This avoids a full
+        copy.deepcopy of the market change, which recursed through every runner for
+        no benefit.
+
         Parameters:
         - mc (dict): The last market change update.
 
         Returns:
         - tuple: A tuple containing the base metadata dictionary, the market ID, and the event ID.
         """
-        
-        metadata = copy.deepcopy(mc)
+
+        metadata = {**mc, "marketDefinition": {**mc["marketDefinition"]}}
         market_id = mc["id"]
         metadata["marketId"] = market_id
         del metadata["id"]
@@ -80,47 +123,72 @@ class MetadataBuilder:
         metadata["eventId"] = event_id
 
         # Convert date strings to datetime objects
-        metadata["marketDefinition"]["openDate"] = datetime.strptime(metadata["marketDefinition"]["openDate"], "%Y-%m-%dT%H:%M:%S.%fZ")
-        metadata["marketDefinition"]["marketTime"] = datetime.strptime(metadata["marketDefinition"]["marketTime"], "%Y-%m-%dT%H:%M:%S.%fZ")
-        metadata["marketDefinition"]["suspendTime"] = datetime.strptime(metadata["marketDefinition"]["suspendTime"], "%Y-%m-%dT%H:%M:%S.%fZ")
+        metadata["marketDefinition"]["openDate"] = _parse_betfair_ts(metadata["marketDefinition"]["openDate"])
+        metadata["marketDefinition"]["marketTime"] = _parse_betfair_ts(metadata["marketDefinition"]["marketTime"])
+        metadata["marketDefinition"]["suspendTime"] = _parse_betfair_ts(metadata["marketDefinition"]["suspendTime"])
 
         return metadata, market_id, event_id
     
 
-    def extend_pre_market(self, ts_ladder_document: dict, pt: pd.Timestamp):
+    def pre_market_indices(self, pts: pd.DatetimeIndex) -> dict:
         """
-        Extend the metadata with the pre0ladder, pre5ladder, pre10ladder fields,
-        where each field is the full ladder containing all runners at the specified
-        time (ie. 10 minutes, 5 minutes and 1 second before the market goes in-play.
-        A deep copy of the ladders is taken to avoid circular converion error when
-        Mongo attemps to convert `ts_document["metadata"]` into BSON.
+        Determine which packet indices carry the pre0ladder, pre5ladder and
+        pre10ladder market states (ie. 1 second, 5 minutes and 10 minutes before
+        the market goes in-play). The sorted millisecond timestamps are
+        binary-searched (np.searchsorted) for the first packet strictly inside
+        each pre in-play window. Resolving the indices before the ladders are
+        built means LadderBuilder.run can hand the matching documents to
+        `capture_pre_market` as they are produced and stream everything else
+        away, instead of keeping the full ladder list around for a scan at the
+        end of the replay.
 
         Parameters:
-        - ts_ladder_document (dict): The ladder document at the specified time.
-        - pt (pd.Timestamp): The timestamp of the ladder document.
+        - pts (pd.DatetimeIndex): The timestamps of all market data packets, in packet order.
+
+        Returns:
+        - dict[int, list[str]]: A mapping from packet index to the pre-market field(s)
+          captured at that index. Multiple fields can share one index when the market
+          goes in-play shortly after the file starts.
         """
 
         # Don't calculate pre0ladder, pre5ladder, pre10ladder if in_play_start is None
         # this handles the edge case where the market never goes in-play
-        if not self.in_play_start:
-            return
+        if self._in_play_start_ms is None or len(pts) == 0:
+            return {}
+
+        pts_ms = pts.asi8 // 1_000_000
+
+        thresholds = {
+            "pre0ladder": ONE_SECOND,
+            "pre5ladder": FIVE_MINUTES,
+            "pre10ladder": TEN_MINUTES,
+        }
+
+        indices: dict = {}
+        for field, threshold in thresholds.items():
+            index = int(np.searchsorted(pts_ms, self._in_play_start_ms - threshold, side="right"))
+            if index < len(pts_ms):
+                indices.setdefault(index, []).append(field)
+
+        return indices
 
-        milliseconds_to_in_play = (self.in_play_start - pt).total_seconds() * 1000
 
-        if not self.pre0ladder and milliseconds_to_in_play < ONE_SECOND:
-            # Technically, milliseconds_to_in_play == 0 would work because pt_date
-            # will eventually be equal to the timestamp returned by get_in_play_pt()
-            # but it's a bit scary to compare them in case of floating point errors
-            self.pre0ladder = ts_ladder_document
-            self.metadata["pre0ladder"] = copy.deepcopy(self.pre0ladder["runners"])
+    def capture_pre_market(self, field: str, ts_ladder_document: dict):
+        """
+        Extend the metadata with one of the pre0ladder, pre5ladder, pre10ladder
+        fields, holding the full ladder for all runners at that point in time.
+        The runners are shared with the captured ladder document rather than deep
+        copied: `ts_document["metadata"]` holds just the market id and the
+        formatted runner dicts are never mutated after a packet is emitted, so
+        there is no reference cycle or aliasing to break.
 
-        if not self.pre5ladder and milliseconds_to_in_play < FIVE_MINUTES:
-            self.pre5ladder = ts_ladder_document
-            self.metadata["pre5ladder"] = copy.deepcopy(self.pre5ladder["runners"])
+        Parameters:
+        - field (str): The metadata field to set ("pre0ladder", "pre5ladder" or "pre10ladder").
+        - ts_ladder_document (dict): The ladder document produced at the captured packet index.
+        """
 
-        if not self.pre10ladder and milliseconds_to_in_play < TEN_MINUTES:
-            self.pre10ladder = ts_ladder_document
-            self.metadata["pre10ladder"] = copy.deepcopy(self.pre10ladder["runners"])
+        setattr(self, field, ts_ladder_document)
+        self.metadata[field] = ts_ladder_document["runners"]
 
 
     def extract_winner_info(self, runner_names: list[str], runner_ids: list[str], status: list[str], bsp: list[float]) -> dict:
@@ -131,7 +199,8 @@ class MetadataBuilder:
         - runner_names (list[str]): The list of runner names.
         - runner_ids (list[str]): The list of runner IDs.
         - status (list[str]): The list of runner statuses.
-        - bsp (list[float]): The list of Betfair Starting Prices (BSP) for each runner.
+        - bsp (list[float]): The list of Betfair Starting Prices (BSP) for each runner,
+          aligned with the other lists (None where a runner has no BSP).
 
         Returns:
         - dict[str, Union[str, float]]: A dictionary containing the winner's name, ID, and BSP (if available). Returns None if no winner is found.
@@ -141,16 +210,18 @@ class MetadataBuilder:
         >>> Output: {'name': 'Runner B', 'id': 456, 'bsp': 3.0}
         """
 
-        if 'WINNER' not in status:
+        # Single scan instead of an `in` check followed by .index(), which
+        # walked the status list twice
+        winner_index = next((index for index, runner_status in enumerate(status) if runner_status == 'WINNER'), -1)
+        if winner_index < 0:
             return
 
-        winner_index = status.index('WINNER')        
         winner_info = {
             'name': runner_names[winner_index],
             'id': runner_ids[winner_index],
         }
 
-        if bsp:
+        if bsp and bsp[winner_index]:
             winner_info['bsp'] = bsp[winner_index]
 
         return winner_info
@@ -163,7 +234,8 @@ class MetadataBuilder:
         Parameters:
         - runner_names (list[str]): The list of runner names.
         - runner_ids (list[str]): The list of runner IDs.
-        - bsp (list[float]): The list of BSPs for each runner.
+        - bsp (list[float]): The list of BSPs for each runner, aligned with the
+          other lists (None where a runner has no BSP).
 
         Returns:
         - list[dict[str, Union[str, float]]]: A list of dictionaries, each containing a favourite's name, ID, and BSP. Sorted by BSP in ascending order.
@@ -176,8 +248,11 @@ class MetadataBuilder:
         if not bsp:
             return
 
+        # itemgetter is a C callable, so sorting skips a Python frame per comparison.
+        # All favourites are stored in the metadata, so the full ordering is kept
+        # rather than truncating to a top-K with heapq.nsmallest.
         bsp_tuples = [(index, bsp) for index, bsp in enumerate(bsp) if bsp]
-        bsp_tuples.sort(key=lambda x: x[1])
+        bsp_tuples.sort(key=itemgetter(1))
 
         return [
             {
@@ -199,15 +274,21 @@ class MetadataBuilder:
         
         market_name: str = self.metadata['marketDefinition']['name']
         runners: list[dict] = self.metadata['marketDefinition']['runners']
-        runner_names, runner_ids, status, bsps = [], [], [], []
 
-        for runner in runners:
-            runner_names.append(runner['name'])
-            runner_ids.append(runner['id'])
-            status.append(runner['status'])
-
-            if runner.get('bsp'):
-                bsps.append(runner['bsp'])
+        # Unpack all runner fields in a single C-level zip pass instead of four
+        # appends per runner. bsps stays aligned with the other lists (None for
+        # runners without a BSP) so indexing by runner position is safe - the
+        # previous append-if-present loop silently misaligned bsps against
+        # runner_names whenever some runners had no BSP.
+        if runners:
+            runner_names, runner_ids, status, bsps = map(list, zip(
+                *((runner['name'], runner['id'], runner['status'], runner.get('bsp')) for runner in runners)
+            ))
+        else:
+            runner_names, runner_ids, status, bsps = [], [], [], []
+
+        if not any(bsps):
+            bsps = []
 
         # Only add fields to mongo document if they exist and are not None
         # When querying mongo, it deals with missing fields better than None
@@ -257,62 +338,42 @@ class HorseRacingMetadataBuilder(MetadataBuilder):
 
         # Fields that are processed and appended to the metadata
         # below are only available for WIN markets for horse racing
-        if self.metadata['marketDefinition']['marketType'] == MarketType.WIN.value:
-            self.metadata['raceTypeAdjusted'] = self.extract_race_type_adjusted(market_name)
-            self.metadata['distance'] = self.extract_distance(market_name)
-            self.metadata['isHandicap'] = self.is_handicap(market_name)
-
-
-    def extract_race_type_adjusted(self, name: str) -> str:
-        """
-        Determines the race type based on the market name.
-
-        Parameters:
-        - name (str): The name of the market.
-
-        Returns:
-        - str: The adjusted race type (e.g., Hurdle, Chase, NH Flat, Flat).
-        """
+        if self.metadata['marketDefinition']['marketType'] == MarketType.WIN:
+            race_type, distance, is_handicap = self.parse_race_name(market_name)
+            self.metadata['raceTypeAdjusted'] = race_type
+            self.metadata['distance'] = distance
+            self.metadata['isHandicap'] = is_handicap
 
-        if 'Hrd' in name or 'Hurdle' in name:
-            return 'Hurdle'
-        elif 'Chs' in name or 'Chase' in name:
-            return 'Chase'
-        elif 'INHF' in name:  
-            return 'NH Flat'
-        else:  
-            return 'Flat'
-        
 
-    def extract_distance(self, name: str) -> str:
+    def parse_race_name(self, name: str) -> tuple:
         """
-        Extracts the race distance from the market name using regular expressions.
+        Extracts the race type, distance and handicap flag from the market name.
+        All three are found in a single traversal of the name via the precompiled
+        _RACE_NAME_RE alternation, instead of six substring scans plus a separate
+        regex search.
 
         Parameters:
         - name (str): The name of the market.
 
         Returns:
-        - str: The race distance (e.g., "2m4f") if found, otherwise an empty string.
+        - tuple[str, str, bool]: The adjusted race type (e.g., Hurdle, Chase, NH Flat, Flat),
+          the race distance (e.g., "2m4f", or an empty string when the name carries no
+          distance), and whether the race is a handicap race.
         """
 
-        # Regex to match the distance in metadat['marketDefinition']['name']
-        match = re.search(r'(\d+m\d*f|\d+m|\d+f)', name)
-        if match:
-            return match.group(0)
-    
-
-    def is_handicap(self, name: str) -> bool:
-        """
-        Determines whether the race is a handicap race based on the market name.
+        race_type = None
+        distance = ''
+        is_handicap = False
 
-        Parameters:
-        - name (str): The name of the market.
-
-        Returns:
-        - bool: True if the race is a handicap race, False otherwise.
-        """
+        for match in _RACE_NAME_RE.finditer(name):
+            if match.lastgroup == 'hcap':
+                is_handicap = True
+            elif match.lastgroup == 'type' and race_type is None:
+                race_type = _RACE_TYPES[match.group('type')]
+            elif match.lastgroup == 'dist' and not distance:
+                distance = match.group('dist')
 
-        return 'Hcap' in name or 'Handicap' in name
+        return race_type or 'Flat', distance, is_handicap
     
 
 class FootballMetadataBuilder(MetadataBuilder):
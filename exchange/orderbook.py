@@ -1,110 +1,153 @@
+import numpy as np
 import pandas as pd
-import json
-from enums import MetaBuilder
+from bson import encode
+from bson.raw_bson import RawBSONDocument
+from sortedcontainers import SortedDict
 from metadata import MetadataBuilder
 
+# How many time series documents are handed to a sink at a time when
+# LadderBuilder.run streams its output instead of returning full lists
+TS_BATCH_SIZE = 1000
+
+# Betfair prices come from a fixed tick ladder of a few hundred values, so the
+# str() of each price is computed once and reused across packets and markets
+_PRICE_STR: dict = {}
+
+
+def _price_str(price: float) -> str:
+    """
+    Return the cached string form of a Betfair price. MongoDB document keys must
+    be strings, and format_ladder stringifies every trd level on every packet;
+    looking the string up in a dict is several times cheaper than str(float).
+
+    Parameters:
+    - price (float): The Betfair price tick.
+
+    Returns:
+    - str: The string representation of the price.
+    """
+
+    value = _PRICE_STR.get(price)
+    if value is None:
+        value = _PRICE_STR.setdefault(price, str(price))
+    return value
+
 
 class LadderBuilder:
-    def __init__(self, marketdata: list[dict], market_definition: dict, meta_builder: MetaBuilder):
+    def __init__(self, marketdata: list[dict], market_definition: dict, meta_builder: type[MetadataBuilder]):
         """
         Initializes the LadderBuilder with market data, market definition, and a reference to a metadata builder.
         Attributes are initialized for storing ladders, default price values, runner IDs, the current ladder structure,
         in-play start and end times, metadata builder instance, market ID, and event ID.
-        
+
         Parameters:
         - marketdata (list[dict]): The list of market updates.
         - market_definition (dict): A dictionary containing the market's definition details.
-        - meta_builder (MetaBuilder): An instance of MetaBuilder for building metadata for the time series data.
+        - meta_builder (type[MetadataBuilder]): The MetadataBuilder subclass for building metadata for the time series data.
         """
 
         self.marketdata = marketdata
         self.market_definition = market_definition
-        
+
+        # All packet timestamps are converted in a single vectorized
+        # pd.to_datetime call; converting per packet paid the scalar
+        # construction overhead once for the in-play scan and again for
+        # the main run loop. np.fromiter fills the int64 array without an
+        # intermediate Python list
+        self._pts: pd.DatetimeIndex = pd.to_datetime(
+            np.fromiter((packet["pt"] for packet in self.marketdata), dtype=np.int64, count=len(self.marketdata)),
+            unit="ms"
+        )
+
+        # if len(mc) != 1 somewhere then the passed in data is not a single market
+        # file; handling multiple markets in one file is not in the scope of this
+        # class. Validated once here instead of per packet in process_packet
+        assert all(len(packet["mc"]) == 1 for packet in self.marketdata)
+
+        # One preprocessing pass resolves what the old per-packet scans
+        # re-derived: each packet's market change and the index of the first
+        # in-play packet. get_in_play_start_pt previously re-processed every
+        # pre in-play packet a second time before run() walked them again
+        self._mcs: list[dict] = [packet["mc"][0] for packet in self.marketdata]
+        self._in_play_start_index: int = self._find_in_play_start_index()
+
         self.ladders = []
         self.default_best_back_price = 0
         self.default_best_lay_price = float("inf")
         self.runner_ids: list[str] = self.get_runner_ids()
-        self.current_ladder: dict = self.create_ladder_ds()
+
+        # Runner state lives in a list indexed by a dense 0..R-1 position, with
+        # the raw integer Betfair id mapped to its position once here. The hot
+        # update path then dispatches on int keys instead of allocating and
+        # hashing a str(runner_id) for every runner change; runner ids are only
+        # stringified at output time in format_ladder
+        self._runner_index: dict[int, int] = {int(runner["id"]): index for index, runner in enumerate(self.market_definition["runners"])}
+        self.current_ladder: list = self.create_ladder_ds()
+
+        # Runners whose ladder changed since the last emitted packet. format_ladder
+        # only re-formats these and reuses the previous output for the rest; all
+        # runners start dirty so the first packet formats everything
+        self._dirty_runners: set[int] = set(range(len(self.runner_ids)))
+        self._formatted: dict = {}
 
         self.in_play_start: pd.Timestamp = self.get_in_play_start_pt()
         self.in_play_end: pd.Timestamp = self.get_in_play_end_pt()
 
-        # Initialize the sport specific metadata builder that was defined in main.py
-        self.metadata_builder = meta_builder.value(self.marketdata, self.in_play_start, self.in_play_end)
+        # Initialize the sport specific metadata builder that was selected in main.py
+        self.metadata_builder = meta_builder(self.marketdata, self.in_play_start, self.in_play_end)
         self.market_id = self.metadata_builder.market_id
         self.event_id = self.metadata_builder.event_id
 
 
-    def list_ladder_to_dict(self, ladder: list[list]) -> dict:
-        """
-        Converts the list ladder Betfair provides to a dictionary to match
-        the structure of self.current_ladder and to enable the use of
-        ladder1.update(ladder2) to efficiently merge the dictionaries.
-
-        Example:
-        >>> Input ladder: [[2.55, 200], [2.5, 120], [2.48, 160]]
-        >>> Output ladder: {2.55: 200, 2.5: 120, 2.48: 160}
-
-        Parameters:
-        - ladder (list[list]): The ladder to convert, where each sublist contains [price, amount].
-        
-        Returns:
-        - dict: A dictionary with prices as keys and amounts as values.
-        """
-
-        return {item[0]: item[1] for item in ladder}
-    
-
-    def update_runner_ladder(self, runner_ladder: dict, runner_change: dict, price_key: str) -> dict:
+    def update_runner_ladder(self, runner_ladder: dict, runner_change: dict, price_key: str):
         """
         Merge the current ladder and the ladder update from the Betfair runner change
-        based on the price_key (atb, atl, trd). Sort the back ladder in descending order
-        and the lay ladder in ascending order and only keep the top 10 prices. This is
+        based on the price_key (atb, atl, trd). The ladder lives in a SortedDict, so
+        price levels stay ordered as they are merged and each touched level costs
+        O(log depth) instead of the full re-sort and dict rebuild per update that the
+        plain dict needed. Zero-volume levels are deleted as the update is applied:
+        Betfair only ever zeroes a level through an explicit update, so checking
+        the incoming pairs covers every removal without rescanning the whole
+        ladder afterwards. The SortedDict is mutated in place; nothing is
+        returned. Selecting the top 10 back and lay prices
+        happens at output time in format_ladder, which also means deeper levels
+        survive and can backfill the top 10 when a best price is cleared. This is
         where the ladder update actually happens.
 
         Parameters:
         - runner_ladder (dict): The current ladder state for a runner.
         - runner_change (dict): The market update information for the runner.
         - price_key (str): The key to identify which part of the ladder to update ('atb', 'atl', or 'trd').
-        
-        Returns:
-        - dict: The updated ladder for the runner.
-        """
-
-        ladder: dict = runner_ladder[price_key]
-        update_list = runner_change.get(price_key, [])
-        update_dict = self.list_ladder_to_dict(update_list)
-
-        ladder.update(update_dict)
-        ladder = {key: value for key, value in ladder.items() if value > 0}
-
-        # only keep the top 10 prices
-        # sorted is an expensive operation, but we are only sorting 10 items
-        if price_key == "atb":
-            # sort back prices in descending order
-            return dict(sorted(ladder.items(), reverse=True)[:10])
-        elif price_key == "atl":
-            # sort lay prices in ascending order
-            return dict(sorted(ladder.items())[:10])
-        elif price_key == "trd":
-            return dict(sorted(ladder.items()))
-        
+        """
+
+        ladder: SortedDict = runner_ladder[price_key]
+
+        # The [price, volume] pairs are written straight into the SortedDict;
+        # building an intermediate dict just to hand it to .update() allocated
+        # and hashed every entry twice
+        for price, volume in runner_change.get(price_key, ()):
+            if volume > 0:
+                ladder[price] = volume
+            else:
+                ladder.pop(price, None)
+
 
-    def create_ladder_ds(self) -> dict:
+    def create_ladder_ds(self) -> list:
         """
-        Create the dictionary of dictionary structure to maintain the current ladder.
-        Uses self.runner_ids to create the sub-dictionaries for each runner.
-        
+        Create the list of dictionaries structure to maintain the current ladder,
+        one dictionary per runner in dense index order (see self._runner_index).
+        The price ladders are SortedDicts keyed by price so they never need
+        re-sorting.
+
         Returns:
-        - dict: A dictionary with runner IDs as keys, each containing a nested dictionary for ladder information.
+        - list: A list with one nested ladder dictionary per runner, aligned with self.runner_ids.
         """
 
-        runners = {}
-        for runner_id in self.runner_ids:
-            runners[runner_id] = {
-                "atb": {},
-                "atl": {},
-                "trd": {},
+        return [
+            {
+                "atb": SortedDict(),
+                "atl": SortedDict(),
+                "trd": SortedDict(),
                 "trades": [],
                 "ltp": None,
                 "tv": None,
@@ -114,57 +157,10 @@ class LadderBuilder:
                 "bbp": self.default_best_back_price,
                 "blp": self.default_best_lay_price,
             }
-        return runners
-    
-
-    def check_arbitrage(self, runner_ladder: dict, runner_id: str, pt: pd.Timestamp) -> bool:
-        """
-        Checks for arbitrage opportunities for a given runner. Also sets the best back `bbp` and
-        best lay prices `blp` for the runner. This is necessary, firstly, to check for arbitrage
-        opportunities based on the most recent state of the runner ladder. Secondly,
-        `update_runner_trades` uses the `bbp` and `blp` to determine which side of the ladder
-        was hit.
-        
-        Parameters:
-        - runner_ladder (dict): The ladder data for the runner.
-        - runner_id (str): The ID of the runner.
-        - pt (pd.Timestamp): The point in time the check is performed.
-        
-        Returns:
-        - bool: True if an arbitrage opportunity is detected, False otherwise.
-        """
-        
-        # atb and atl are already sorted
-        best_back_price = runner_ladder["atb"][0][0] if runner_ladder.get("atb") else self.default_best_back_price
-        best_lay_price = runner_ladder["atl"][0][0] if runner_ladder.get("atl") else self.default_best_lay_price
-        self.current_ladder[runner_id]["bbp"] = best_back_price
-        self.current_ladder[runner_id]["blp"] = best_lay_price
-
-        if best_back_price > best_lay_price:
-            # print("Arbitrage opportunity detected at timestamp: ", pt.timestamp())
-            # print(best_back_price, best_lay_price, runner_id)
-            # print(json.dumps(runner_ladder, indent=4))
-            return True
-        
-        return False
+            for _ in self.runner_ids
+        ]
     
 
-    def raise_if_arbitrage(self, ladder: dict, pt: str) -> bool:
-        """
-        Raises an alert if arbitrage is detected in any runner's ladder.
-        
-        Parameters:
-        - ladder (dict): The current state of the ladder for all runners.
-        - pt (pd.Timestamp): The point in time the check is performed.
-        """
-
-        runner_ladders = ladder["runners"]
-        for runner_id in runner_ladders.keys():
-            if self.check_arbitrage(runner_ladders[runner_id], runner_id, pt):
-                # raise ValueError("Arbitrage opportunity detected. Investiage further.")
-                pass
-
-    
     def update_runner_value(self, runner_ladder: dict, runner_change: dict, key: str) -> dict:
         """
         Update the single value fields in the runner ladder, such as `ltp` and `tv` based on
@@ -180,46 +176,30 @@ class LadderBuilder:
         return value if value else runner_ladder[key]
     
 
-    def get_update_by_runner_id(self, runner_id: str, rc: dict, price_key: str) -> dict:
-        """
-        Retrieves updates for a specific runner based on runner ID and update type.
-        
-        Parameters:
-        - runner_id (str): The ID of the runner.
-        - rc (dict): The runner change data.
-        - price_key (str): The key indicating the type of ladder update.
-        
-        Returns:
-        - dict: The updates for the specified runner.
-        """
-
-        for runner_change in rc:
-            if str(runner_change["id"]) == runner_id and runner_change.get(price_key):
-                return self.list_ladder_to_dict(runner_change[price_key])
-            
-        return {}
-    
-
-    def update_runner_trades(self, runner_id: str, runner_ladder: dict, runner_change: dict) -> dict:
+    def update_runner_trades(self, runner_ladder: dict, runner_change: dict) -> dict:
         """
         Update the trades dictionary in the runner ladder. Trades are stored in a dictionary
         with the key being the price and the value being the volume traded at that price.
+        The previous traded volume lookup and the bbp/blp thresholds are bound to locals
+        once per call, so the per-trade loop does no repeated dict lookups.
 
         Parameters:
-        - runner_id (str): The ID of the runner.
         - runner_ladder (dict): The ladder data for the runner.
         - runner_change (dict): The market update information for the runner.
         """
 
-        trades = []
+        trd_update = runner_change.get("trd")
+        if not trd_update:
+            return []
 
-        current_trd: dict = runner_ladder["trd"]
-        for trd_update in runner_change.get("trd", []):
-            traded_price = trd_update[0]
-            total_volume = trd_update[1]
+        trades = []
+        get_traded_volume = runner_ladder["trd"].get
+        best_back_price = runner_ladder["bbp"]
+        best_lay_price = runner_ladder["blp"]
+        total_traded = runner_ladder["ttrdv"]
 
-            traded_volume = total_volume - current_trd.get(traded_price, 0)
-            traded_volume = round(traded_volume, 2)
+        for traded_price, total_volume in trd_update:
+            traded_volume = round(total_volume - get_traded_volume(traded_price, 0), 2)
 
             # Disregard trades with a volume less than 0.0 as they are associated with
             # changes in the underlying foreign currency exchange rates. TODO This is an arbitrary
@@ -228,14 +208,15 @@ class LadderBuilder:
             if traded_volume <= 0.0:
                 continue
 
-            runner_ladder["ttrdv"] += traded_volume
-            if traded_price <= runner_ladder["bbp"]:
+            total_traded += traded_volume
+            if traded_price <= best_back_price:
                 trades.append([traded_price, traded_volume, "b"])
-            elif traded_price >= runner_ladder["blp"]:
+            elif traded_price >= best_lay_price:
                 trades.append([traded_price, traded_volume, "l"])
             else:
                 trades.append([traded_price, traded_volume, "nan"])
-                
+
+        runner_ladder["ttrdv"] = total_traded
         return trades
 
 
@@ -251,19 +232,30 @@ class LadderBuilder:
 
         rc = market_change["rc"]
         for runner_change in rc:
-            runner_id = str(runner_change["id"])
-            runner_ladder = self.current_ladder[runner_id]
+            runner_index = self._runner_index[runner_change["id"]]
+            runner_ladder = self.current_ladder[runner_index]
 
             # Must update trades before trd as we need the previous trd to calculate the
-            # size of trades.
-            runner_ladder["trades"] = self.update_runner_trades(runner_id, runner_ladder, runner_change)
-            runner_ladder["atb"] = self.update_runner_ladder(runner_ladder, runner_change, "atb")
-            runner_ladder["atl"] = self.update_runner_ladder(runner_ladder, runner_change, "atl")
-            runner_ladder["trd"] = self.update_runner_ladder(runner_ladder, runner_change, "trd")
+            # size of trades. The SortedDicts are mutated in place, so only the
+            # scalar fields need a store back into the runner ladder
+            runner_ladder["trades"] = self.update_runner_trades(runner_ladder, runner_change)
+            self.update_runner_ladder(runner_ladder, runner_change, "atb")
+            self.update_runner_ladder(runner_ladder, runner_change, "atl")
+            self.update_runner_ladder(runner_ladder, runner_change, "trd")
             runner_ladder["ltp"] = self.update_runner_value(runner_ladder, runner_change, "ltp")
             runner_ladder["tv"] = self.update_runner_value(runner_ladder, runner_change, "tv")
-            
-            self.current_ladder[runner_id] = runner_ladder
+
+            # Best back is the highest atb price and best lay the lowest atl
+            # price, both O(1) off the ends of the SortedDicts.
+            # update_runner_trades reads bbp/blp on this runner's next change
+            # to decide which side of the book a trade hit, so they are
+            # refreshed right after the ladders they derive from
+            atb: SortedDict = runner_ladder["atb"]
+            atl: SortedDict = runner_ladder["atl"]
+            runner_ladder["bbp"] = atb.peekitem(-1)[0] if atb else self.default_best_back_price
+            runner_ladder["blp"] = atl.peekitem(0)[0] if atl else self.default_best_lay_price
+
+            self._dirty_runners.add(runner_index)
     
 
     def update_market_definition(self, market_change: dict) -> dict:
@@ -290,46 +282,62 @@ class LadderBuilder:
         be replaced for example with the best back price to get the trd volume at the best back
         price.
 
+        Only runners marked dirty since the last packet are re-formatted; the rest
+        reuse the entry built for the previous packet. Most packets touch one or two
+        runners, so this skips rebuilding the full ladder for every unchanged runner.
+        Reused entries are never mutated after they are built (a dirty runner gets a
+        brand new dict), which keeps the documents already appended to self.ladders
+        untouched.
+
         Returns:
         - dict: A dictionary representing the formatted ladder, where each key is a runner ID and each
-                value is a dictionary containing the formatted 'atb', 'atl', 'trd', 'ltp', 'tv', 'ttrdv',
-                and 'trades' data for the runner.
+                value is a pre-encoded RawBSONDocument containing the formatted 'atb', 'atl', 'trd',
+                'ltp', 'tv', 'ttrdv', and 'trades' data for the runner.
         """
 
-        output_dict = {}
-        for runner, ladder in self.current_ladder.items():
-            output_dict[runner] = {}
+        for runner_index in self._dirty_runners:
+            ladder = self.current_ladder[runner_index]
+            formatted_runner = {}
 
             # Only add fields to mongo document if they exist and are not None
             # When querying mongo, it deals with missing fields better than None
             if ladder["atb"]:
-                output_dict[runner]["atb"] = [[k, v] for k, v in ladder["atb"].items()]
+                # only keep the top 10 prices; back prices in descending order
+                formatted_runner["atb"] = [[k, v] for k, v in reversed(ladder["atb"].items()[-10:])]
 
             if ladder["atl"]:
-                output_dict[runner]["atl"] = [[k, v] for k, v in ladder["atl"].items()]
+                # only keep the top 10 prices; lay prices in ascending order
+                formatted_runner["atl"] = [[k, v] for k, v in ladder["atl"].items()[:10]]
 
             if ladder["trd"]:
-                # Keys in MongoDB must be strings
-                output_dict[runner]["trd"] = {str(k): v for k, v in ladder["trd"].items()}
+                # Keys in MongoDB must be strings; the tick strings are interned
+                formatted_runner["trd"] = {_price_str(k): v for k, v in ladder["trd"].items()}
 
             if ladder["ltp"]:
-                output_dict[runner]["ltp"] = ladder["ltp"]
+                formatted_runner["ltp"] = ladder["ltp"]
 
             if ladder["tv"]:
-                output_dict[runner]["tv"] = ladder["tv"]
+                formatted_runner["tv"] = ladder["tv"]
 
             if ladder["ttrdv"]:
-                output_dict[runner]["ttrdv"] = round(ladder["ttrdv"], 2)
+                formatted_runner["ttrdv"] = round(ladder["ttrdv"], 2)
 
             if ladder["trades"]:
-                output_dict[runner]["trades"] = ladder["trades"]
+                formatted_runner["trades"] = ladder["trades"]
                 # ladder["trades"] = [] # Reset trades to avoid appending old trades to new ladder
 
             # Could add best back and lay price to mongo here, if needed. Adding them would make
             # querying the best back and lay price for each runner slightly simpler. Other than that,
             # there's no need to store them.
 
-        return output_dict
+            # Runner ids only become strings here, at output time. The runner is
+            # BSON-encoded once when it changes; pymongo's encoder splices the
+            # raw bytes into every ts document that reuses this entry instead of
+            # re-walking the nested dict on each insert
+            self._formatted[self.runner_ids[runner_index]] = RawBSONDocument(encode(formatted_runner))
+
+        self._dirty_runners.clear()
+        return dict(self._formatted)
     
 
     def create_ts_document(self, ladder: dict, market_definition: dict, pt: pd.Timestamp) -> dict:
@@ -364,22 +372,36 @@ class LadderBuilder:
         return ts_document
 
 
-    def get_in_play_start_pt(self) -> pd.Timestamp:
+    def _find_in_play_start_index(self) -> int:
         """
-        Determines the in-play start timestamp from the market data by looping through the
-        raw Betfair updates until the first inPlay: true field is found.
+        Finds the index of the first packet whose market definition reports
+        inPlay: true, scanning the preprocessed market changes once.
 
         Returns:
-        - pd.Timestamp: The timestamp when the market goes in-play, if available.
+        - int: The index of the first in-play packet, or None if the market never goes in-play.
         """
 
-        for packet in self.marketdata:
-            pt, market_change = self.process_packet(packet)
+        for index, market_change in enumerate(self._mcs):
             market_definition = market_change.get("marketDefinition")
-            
+
             if market_definition and market_definition["inPlay"]:
-                return pt
-            
+                return index
+
+
+    def get_in_play_start_pt(self) -> pd.Timestamp:
+        """
+        Returns the in-play start timestamp resolved by the preprocessing pass
+        in __init__, if the market ever goes in-play.
+
+        Returns:
+        - pd.Timestamp: The timestamp when the market goes in-play, if available.
+        """
+
+        if self._in_play_start_index is None:
+            return None
+
+        return self._pts[self._in_play_start_index]
+
 
     def get_in_play_end_pt(self) -> pd.Timestamp:
         """
@@ -389,8 +411,7 @@ class LadderBuilder:
         - pd.Timestamp: The timestamp corresponding to the last market data packet.
         """
 
-        pt_date, market_change = self.process_packet(self.marketdata[-1])
-        return pt_date
+        return self._pts[-1]
 
 
     def get_runner_ids(self) -> list[str]:
@@ -405,25 +426,24 @@ class LadderBuilder:
         return [str(runner["id"]) for runner in runner_objects]
     
 
-    def process_packet(self, packet: dict):
+    def process_packet(self, index: int, packet: dict):
         """
         Processes a single packet (or update) of market data, extracting the timestamp and market change.
+        The timestamp comes from the batch-converted `self._pts` rather than a per-packet
+        pd.to_datetime call.
 
         Parameters:
+        - index (int): The position of the packet within the market data.
         - packet (dict): A single packet of market data.
 
         Returns:
         - tuple[pd.Timestamp, dict]: A tuple containing the processed timestamp and the market change dictionary.
         """
 
-        pt = packet["pt"]
-        mc = packet["mc"]
-        market_change: dict = mc[0]
-        pt_date: pd.Timestamp = pd.to_datetime(pt, unit="ms")
-    
-        # if len(mc) != 1 then the passed in data is not a single market file
-        # handling multiple markets in a single file is not in the scope of this function
-        assert len(mc) == 1
+        # The single-market invariant (len(mc) == 1) is validated once in
+        # __init__, and the market changes were unwrapped there too
+        market_change: dict = self._mcs[index]
+        pt_date: pd.Timestamp = self._pts[index]
 
         return pt_date, market_change
     
@@ -454,25 +474,46 @@ class LadderBuilder:
         Reset the trades dictionary in the runner ladder. Trades are stored in a list
         eg. `[2.2, 34.11, "b"]` If not reset, old trades would be appended to every ladder
         update. Could reset trades inside format_ladder by setting `ladder["trades"] = []`
-        but for clarity it is done here.
+        but for clarity it is done here. Runners whose trades were just cleared are
+        re-marked dirty so format_ladder drops the stale trades from the next packet's
+        document even if the runner receives no further updates.
         """
 
-        for runner_id, ladder in self.current_ladder.items():
-            ladder["trades"] = []
+        for runner_index, ladder in enumerate(self.current_ladder):
+            if ladder["trades"]:
+                ladder["trades"] = []
+                self._dirty_runners.add(runner_index)
 
 
-    def run(self):
+    def run(self, ts_sink=None, raw_sink=None):
         """
         Executes the main logic of `LadderBuilder`. Processes market data packets to update the ladders,
         format them, create time series documents, and construct metadata document.
 
+        When ts_sink and/or raw_sink callables are provided, the ladder and raw
+        market data documents are handed to them in batches of TS_BATCH_SIZE as
+        they are produced instead of being accumulated in self.ladders and
+        returned, so at most one batch of ladder documents lives in memory at a
+        time. The pre in-play market states the metadata needs are resolved up
+        front via `pre_market_indices` and captured as the matching packets go
+        past, which is what makes discarding the rest of the ladders safe.
+
+        Parameters:
+        - ts_sink (Callable[[list[dict]], None]): Optional sink receiving batches of ladder time series documents.
+        - raw_sink (Callable[[list[dict]], None]): Optional sink receiving batches of raw market data documents.
+
         Returns:
-        - tuple[dict, list, list]: A tuple containing the final metadata, a list of time series documents, 
-                                and the processed market data packets.
+        - tuple[dict, list, list]: A tuple containing the final metadata, a list of time series documents,
+                                and the processed market data packets. The time series list is empty
+                                when ts_sink is given, as the documents have already been sent to it.
         """
 
+        pre_market_fields: dict = self.metadata_builder.pre_market_indices(self._pts)
+        ts_batch = []
+        raw_batch = []
+
         for i, packet in enumerate(self.marketdata):
-            pt, market_change = self.process_packet(packet)
+            pt, market_change = self.process_packet(i, packet)
             self.marketdata[i] = self.set_raw_marketdata(packet, pt)
 
             self.update_ladder(market_change)
@@ -480,10 +521,29 @@ class LadderBuilder:
             formatted_ladder = self.format_ladder()
             ts_ladder_document = self.create_ts_document(formatted_ladder, market_definition, pt)
 
-            self.raise_if_arbitrage(ts_ladder_document, pt)
-            self.metadata_builder.extend_pre_market(ts_ladder_document, pt)
-            self.ladders.append(ts_ladder_document)
+            for field in pre_market_fields.get(i, ()):
+                self.metadata_builder.capture_pre_market(field, ts_ladder_document)
+
             self.reset_runner_trades()
-        
+
+            if ts_sink:
+                ts_batch.append(ts_ladder_document)
+                if len(ts_batch) >= TS_BATCH_SIZE:
+                    ts_sink(ts_batch)
+                    ts_batch = []
+            else:
+                self.ladders.append(ts_ladder_document)
+
+            if raw_sink:
+                raw_batch.append(packet)
+                if len(raw_batch) >= TS_BATCH_SIZE:
+                    raw_sink(raw_batch)
+                    raw_batch = []
+
+        if ts_sink and ts_batch:
+            ts_sink(ts_batch)
+        if raw_sink and raw_batch:
+            raw_sink(raw_batch)
+
         self.metadata_builder.extend_post_market()
         return self.metadata_builder.get(), self.ladders, self.marketdata
\ No newline at end of file
@@ -1,18 +1,38 @@
 import gridfs
-import json
+import orjson
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from pymongo.collection import Collection
 from pymongo.database import Database
 from gridfs.errors import FileExists
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
 from exchange.enums import MongoURIs
 from enum import Enum
 import concurrent.futures
+import itertools
 import multiprocessing
+import os
+
+
+# One MongoClient per URI, shared by every MongoDB instance in the process.
+# Constructing a client pays TLS handshakes and starts replica-set monitoring
+# threads, so reopening one per market thrashed connections; interning the
+# client here means the connection pool is actually reused. The cache is keyed
+# by pid as well as URI because forked worker processes inherit the parent's
+# dict: a MongoClient opened before the fork is not fork-safe (its sockets and
+# monitor threads don't survive), so a child must miss the cache and open its
+# own client rather than reuse the parent's
+_CLIENTS: dict = {}
 
 
 class MongoDB():
+    # One bounded upload pool shared by every MongoDB instance in the process.
+    # The previous per-call `with ThreadPoolExecutor(...)` spawned and tore down
+    # cpu_count() threads on every insert_many; the pool is capped because each
+    # worker pins a connection from the underlying MongoClient pool
+    _pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(32, multiprocessing.cpu_count() * 2))
+
     def __init__(self, db: Enum, uri: Enum = MongoURIs.Test):
         """
         Initializes a MongoDB client connection using a specified database and URI.
@@ -23,9 +43,42 @@ class MongoDB():
         """
 
         self.uri = uri.value
-        self.client = MongoClient(self.uri, server_api=ServerApi('1'), maxPoolSize=1000)
+
+        # maxPoolSize is bounded well below the old 1000: the upload pool caps
+        # concurrent batch inserts anyway, and oversized pools just pile up
+        # connections the server has to track. minPoolSize/maxIdleTimeMS keep a
+        # warm core of connections alive between markets
+        pid = os.getpid()
+        client_key = (pid, self.uri)
+        if client_key not in _CLIENTS:
+            # Drop clients inherited from a parent process on the first miss
+            # after a fork; their keys carry the parent's pid and they must not
+            # be used (or kept alive) in this process
+            for stale_key in [key for key in _CLIENTS if key[0] != pid]:
+                del _CLIENTS[stale_key]
+
+            _CLIENTS[client_key] = MongoClient(
+                self.uri,
+                server_api=ServerApi('1'),
+                maxPoolSize=200,
+                minPoolSize=10,
+                maxIdleTimeMS=300_000
+            )
+
+        self.client = _CLIENTS[client_key]
         self.db = self.client[db.value]
 
+        # Per-collection document buffers used by buffer_insert to coalesce
+        # small per-file uploads into larger insert_many batches
+        self._buffers: dict = {}
+        self._buffer_types: dict = {}
+        self._buffer_write_concerns: dict = {}
+
+        # Collection names known to exist, fetched lazily on the first time
+        # series insert so insert_many doesn't pay a list_collection_names
+        # server round-trip per call
+        self._known_collections: set = None
+
 
     def insert_one(self, collection: Enum, data):
         """
@@ -52,82 +105,184 @@ class MongoDB():
         return result
 
 
-    def insert_many(self, collection: Enum, data: list, metadata_duplicated = None, type: str = None):
+    def insert_many(self, collection: Enum, data, metadata_duplicated = None, type: str = None, w: int = 1):
         """
         Load multiple files (ie. data) to a MongoDB Collection. Specify metadata_duplicated
         if you only want to upload ladder data if its associated metadata is not duplicated.
         Time series doesn't support unique indexes. A DuplicateKeyError would never be raised
         when uploading ladder data, therefore, we need to check if the metadata is duplicated.
         You might still want to upload ladder data even if the metadata is duplicated, in this
-        case, don't specify metadata_duplicated when calling insert many. Function implements
-        multiprocessing to increase efficiency when uploading more than 1000 documents.
+        case, don't specify metadata_duplicated when calling insert many. Batches of 1000
+        documents are uploaded concurrently on the shared class-level thread pool, and
+        every batch future is awaited so no failed batch goes unnoticed (the previous
+        per-call executor only checked the last submitted future).
+
+        Accepts any iterable, not just a list: documents are pulled in batches of
+        1000 via itertools.islice, so a streaming producer (eg. LadderBuilder.run
+        with a sink) is never materialized in full here.
+
+        Pass w=0 to insert with an unacknowledged write concern, so batches do not
+        block on the server round-trip. Only the time series uploads should opt in:
+        they have no unique indexes, duplicates are filtered out before the data is
+        produced, and losing per-document acks there is an acceptable trade for
+        throughput. The metadata insert (insert_one) must stay acknowledged because
+        its DuplicateKeyError carries information.
 
         Parameters:
         - collection (Enum): The collection Enum where the documents will be inserted.
-        - data (list): A list of documents to insert.
+        - data (Iterable[dict]): The documents to insert.
         - metadata_duplicated: An optional parameter to specify handling of duplicated metadata.
         - type (str): An optional parameter to specify if the collection is a time series. Use "ts" for time series.
+        - w (int): The write concern for the inserts. Use 0 for unacknowledged time series uploads. Defaults to 1.
 
         Returns:
-        - InsertManyResult: The result of the insert operation, including the IDs of the inserted documents.
+        - InsertManyResult: The result of the last insert operation, including the IDs of the inserted documents.
         """
 
         if isinstance(metadata_duplicated, DuplicateKeyError):
             print(f"Duplicate Error: Not uploading data files to '{collection.name}' because metadata is duplicated.")
             return
         
-        # Create time series collection with specific options if it doesn't exist
-        if collection.value not in self.db.list_collection_names() and type == "ts":
-            timeseries = {
-                "timeField": "pt",
-                "metaField": "metadata",
-                "granularity": "seconds"
-            }
-
-            self.db.create_collection(
-                collection.value,
-                timeseries=timeseries
-            )
-
-        collection: Collection = self.db[collection.value]
-        try:
-            if len(data) < 1000:
-                # Insert directly if data is small
-                result = collection.insert_many(data, ordered=False)
-            else:
-                # Insert in batches of 1000 with multithreading
-                with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
-                    for i in range(0, len(data), 1000):
-                        future = executor.submit(collection.insert_many, data[i:i+1000], ordered=False)
-
-                    result = future.result()
+        # Create time series collection with specific options if it doesn't exist.
+        # The existing names are listed once and cached; every later call checks
+        # the local set instead of asking the server again
+        if type == "ts":
+            if self._known_collections is None:
+                self._known_collections = set(self.db.list_collection_names())
+
+            if collection.value not in self._known_collections:
+                timeseries = {
+                    "timeField": "pt",
+                    "metaField": "metadata",
+                    "granularity": "seconds"
+                }
+
+                self.db.create_collection(
+                    collection.value,
+                    timeseries=timeseries
+                )
+                self._known_collections.add(collection.value)
+
+        if w == 0:
+            collection: Collection = self.db.get_collection(collection.value, write_concern=WriteConcern(w=0))
+        else:
+            collection: Collection = self.db[collection.value]
+
+        data_iter = iter(data)
+        first_batch = list(itertools.islice(data_iter, 1000))
+        if not first_batch:
+            return
 
-            print(f"Inserted '{len(data)}' documents into the '{collection.name}'.")
+        total_documents = len(first_batch)
+        if total_documents < 1000:
+            # Insert directly if data is small, skipping the pool round-trip
+            try:
+                result = collection.insert_many(first_batch, ordered=False)
+                print(f"Inserted '{total_documents}' documents into the '{collection.name}'.")
+            except DuplicateKeyError as e:
+                result = e
+                print(f"Duplicate Error: Failed to upload with error into '{collection.name}': {e}")
+
+            return result
+
+        # Insert in batches of 1000 concurrently on the shared pool
+        futures = [self._pool.submit(collection.insert_many, first_batch, ordered=False)]
+        for batch in iter(lambda: list(itertools.islice(data_iter, 1000)), []):
+            total_documents += len(batch)
+            futures.append(self._pool.submit(collection.insert_many, batch, ordered=False))
+
+        # Await every batch so a failure in any of them surfaces, not just
+        # the last submitted one
+        result = None
+        errors = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except (DuplicateKeyError, BulkWriteError) as e:
+                errors.append(e)
+
+        if errors:
+            result = errors[-1]
+            print(f"Failed to upload '{len(errors)}' batches into '{collection.name}' with errors: {errors}")
+        else:
+            print(f"Inserted '{total_documents}' documents into the '{collection.name}'.")
 
-        except DuplicateKeyError as e:
-            result = e
-            print(f"Duplicate Error: Failed to upload with error into '{collection.name}': {e}")
-        
         return result
     
 
-    def find(self, collection: Enum, filter: dict, projection: dict = None):
+    def buffer_insert(self, collection: Enum, data: list, metadata_duplicated = None, type: str = None, flush_at: int = 1000, w: int = 1):
         """
-        Execute the query to get the list of matching documents in the specified collection.
-        The database must already be set inside `self.db`.
+        Queue documents for insertion into the specified collection, flushing with a
+        single insert_many once at least `flush_at` documents have accumulated. The
+        pipeline produces three Mongo operations per market file; buffering across
+        files amortizes the network round-trip and per-command overhead for the
+        high-volume time series collections. Call `flush` (or let the atexit hook
+        registered by the pipeline do it) to upload any remaining documents.
+
+        Like insert_many, specify metadata_duplicated to skip the upload when the
+        file's associated metadata turned out to be a duplicate.
+
+        Parameters:
+        - collection (Enum): The collection Enum where the documents will be inserted.
+        - data (list): A list of documents to queue for insertion.
+        - metadata_duplicated: An optional parameter to specify handling of duplicated metadata.
+        - type (str): An optional parameter to specify if the collection is a time series. Use "ts" for time series.
+        - flush_at (int): The buffered document count that triggers a flush.
+        - w (int): The write concern the flushes use for this collection (see insert_many). Defaults to 1.
+        """
+
+        if isinstance(metadata_duplicated, DuplicateKeyError):
+            print(f"Duplicate Error: Not buffering data files for '{collection.value}' because metadata is duplicated.")
+            return
+
+        buffer = self._buffers.setdefault(collection, [])
+        self._buffer_types[collection] = type
+        self._buffer_write_concerns[collection] = w
+        buffer.extend(data)
+
+        if len(buffer) >= flush_at:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Insert all buffered documents into their collections. Safe to call when
+        nothing is buffered, so it can run unconditionally on shutdown.
+        """
+
+        for collection, buffer in self._buffers.items():
+            if buffer:
+                self.insert_many(
+                    collection,
+                    buffer,
+                    type=self._buffer_types.get(collection),
+                    w=self._buffer_write_concerns.get(collection, 1)
+                )
+                self._buffers[collection] = []
+
+
+    def find(self, collection: Enum, filter: dict, projection: dict = None, batch_size: int = 1000):
+        """
+        Execute the query and return a lazy cursor over the matching documents in
+        the specified collection. The database must already be set inside `self.db`.
+        The cursor fetches `batch_size` documents per server round-trip, so peak
+        memory stays at one batch regardless of the result size; previously the
+        whole result set was materialized into a list before the caller saw the
+        first document. Wrap in list(...) if random access is really needed, or
+        use find_one when only sampling a single document.
 
         Parameters:
         - collection (Enum): The collection Enum to query.
         - filter (dict): The query filter.
         - projection (dict): An optional projection specifying which fields to include or exclude.
+        - batch_size (int): The number of documents fetched per server round-trip.
 
         Returns:
-        - list: A list of queried documents.
+        - Cursor: A lazy cursor over the queried documents.
         """
 
         collection: Collection = self.db[collection.value]
-        mongoCursor = collection.find(filter, projection)
-        return list(mongoCursor)
+        return collection.find(filter, projection).batch_size(batch_size)
     
 
     def find_one(self, collection: Enum, filter: dict, projection: dict = None):
@@ -169,7 +324,11 @@ class GridFs():
 
     def upload_file(self, json_content, metadata):
         """
-        Uploads a file to GridFS with specified content and metadata.
+        Uploads a file to GridFS with specified content and metadata. The content
+        is encoded straight to bytes with orjson, so GridFS stores the payload
+        as-is instead of re-encoding a Python str, and a 4 MiB chunkSize keeps
+        the number of fs.chunks documents (one insert each) low for the multi-MB
+        marketdata payloads compared to the default 255 KiB chunks.
 
         Parameters:
         - json_content (dict): The JSON content of the file to upload.
@@ -184,7 +343,7 @@ class GridFs():
 
         # eg. "ladders_1.208050898_31954040"
         id = f"{self.prefix}_{market_id}_{event_id}"
-        data_str = json.dumps(json_content)
+        data_bytes = orjson.dumps(json_content)
 
         file_metadata = {
             "eventId": event_id,
@@ -193,7 +352,7 @@ class GridFs():
         }
 
         try:
-            reponse = self.fs.put(data_str, filename=market_id, encoding='utf-8', **file_metadata)
+            reponse = self.fs.put(data_bytes, filename=market_id, chunkSize=4 * 1024 * 1024, **file_metadata)
             print(f"Inserted document with id '{id}' into the '{self.prefix}' GridFS.")
             return reponse
         except FileExists as e:
@@ -202,7 +361,11 @@ class GridFs():
 
     def retrieve_file_from_gridfs(self, file_metadata):
         """
-        Retrieve a file from GridFS using the specified file metadata.
+        Retrieve a file from GridFS using the specified file metadata. The file is
+        read through GridOut.read(), which assembles the chunks into one
+        preallocated buffer, instead of querying the chunks collection by hand and
+        growing a bytes object chunk by chunk (a quadratic copy for large files).
+        orjson then parses the returned bytes directly without a decode pass.
 
         Parameters:
         - file_metadata (dict): Metadata used to identify the file, including 'marketId' and 'eventId'.
@@ -211,30 +374,13 @@ class GridFs():
         - dict: The content of the retrieved file as a JSON dictionary.
         """
 
-        file_document = self.fs.find(file_metadata)
-        documents = list(file_document)
-        if len(documents) == 0:
+        grid_out = self.fs.find_one(file_metadata)
+        if grid_out is None:
             print("No documents found with the specified metadata.")
             return
-        
-        print("Documents found:")
-        for doc in documents:
-            print("File Document:", doc)
-            file_id = doc._id
-            chunks_query = {"files_id": file_id}
-            chunks_collection_name = self.fs._GridFS__collection.name + ".chunks"
-            chunks_cursor = self.db[chunks_collection_name].find(chunks_query).sort("n")
-
-            # Collect binary data from chunks
-            file_data = b''
-            for chunk in chunks_cursor:
-                file_data += chunk['data']
-
-            # Decode binary data to string
-            json_data_str = file_data.decode('utf-8')
-            json_data = json.loads(json_data_str)
-
-        return json_data
+
+        print("File Document:", grid_out._id)
+        return orjson.loads(grid_out.read())
     
 
     def get_grid_fs_id(self, metadata):
@@ -1,11 +1,20 @@
 import boto3
 from mypy_boto3_s3.client import S3Client
+from collections.abc import Iterator
 from datetime import datetime
-import json
 import bz2
+import concurrent.futures
 from enums import AWS
 
 
+class CorruptMarketFileError(Exception):
+    """
+    Raised when a market file's bz2 stream cannot be fully decompressed.
+    Signals that any lines already yielded are an incomplete prefix of the
+    file, so the caller must discard them rather than process a partial market.
+    """
+
+
 class S3():
     def __init__(self, folder: str):
         """
@@ -31,64 +40,146 @@ class S3():
         self.bucket = AWS.Bucket.value
         self.s3_client: S3Client = boto3.client("s3", aws_access_key_id=self.key, aws_secret_access_key=self.secret)
 
-    def get_file_content(self, file_key: str) -> list[str]:
+    def get_file_content(self, file_key: str) -> list[bytes]:
         """
-        Fetches and decompresses the content of a specified file from S3, returning its contents as a list of strings.
+        Fetches and decompresses the content of a specified file from S3, returning its contents as a list of bytes.
 
-        Each string in the returned list represents one line from the decompressed file content. If the file
-        cannot be decompressed, this function returns None. This might happen due to issues with the uploaded
-        files from Kishore's script.
+        Each entry in the returned list represents one line from the decompressed file content. Lines are kept
+        as raw UTF-8 bytes because the downstream JSON parsing (orjson) accepts bytes directly, which avoids
+        decoding the whole file to str. If the file cannot be decompressed, this function returns None. This
+        might happen due to issues with the uploaded files from Kishore's script.
 
         Parameters:
         - file_key (str): The key (path) of the file within the S3 bucket to fetch.
 
         Returns:
-        - Optional[List[str]]: A list of strings representing the decompressed file content, or None if an error occurs.
+        - Optional[List[bytes]]: A list of bytes representing the decompressed file content, or None if an error occurs.
 
         Example:
         - Input: file_key = ""horse-racing/2023/Jan/3/322919/1.23456.bz2""
-        - Output: [..."rc":[{"atb":[[1.01,20]]..., ..."rc":[{"atl":[[2.05,12]]...] or None
+        - Output: [...b"rc":[{"atb":[[1.01,20]]..., ...b"rc":[{"atl":[[2.05,12]]...] or None
         """
 
         response = self.s3_client.get_object(Bucket=self.bucket, Key=file_key)
-        compressed_content = response['Body'].read()
+        decompressor = bz2.BZ2Decompressor()
+        decompressed_chunks = []
 
         try:
-            content = bz2.decompress(compressed_content).decode("utf-8")
-            return content.splitlines()
+            # Decompress incrementally as the body streams in, so the full
+            # compressed file is never held in memory alongside its output
+            for chunk in response['Body'].iter_chunks(64 * 1024):
+                decompressed_chunks.append(decompressor.decompress(chunk))
         except Exception as e:
             # get_file_content might return None if the bz2 can't be decompressed
             # and should be skipped (this is a known issue from downloading data from Betfair)
             print(f"Error decompressing file: {file_key}")
             return None
 
+        # The incremental decompressor only raises on invalid data; a stream cut
+        # short before the end-of-stream marker ends quietly with eof unset, which
+        # the one-shot bz2.decompress would have reported as an error
+        if not decompressor.eof:
+            print(f"Error decompressing file: {file_key}, compressed stream ended early")
+            return None
+
+        return b"".join(decompressed_chunks).splitlines()
 
-    def fetch_files_from_s3(self) -> list[str]:
+
+    def get_many(self, file_keys, workers: int = 64) -> Iterator[list[bytes]]:
         """
-        Retrieves the keys of all files located in the specified folder within the S3 bucket.
+        Fetches and decompresses several files concurrently, yielding the line
+        lists in the order of the given keys. Each download is a small
+        independent request whose wall time is dominated by the S3 round-trip,
+        so fanning out over a thread pool overlaps the waits (the boto3 client
+        is thread-safe). Useful for callers that consume whole files from a
+        single process; the multiprocess pipeline in main.py instead downloads
+        inside its worker processes.
 
-        This method lists all files present in the initialized folder and collects their keys. If the listing
-        is truncated due to the high number of files, it continues to fetch until all files are listed.
+        Parameters:
+        - file_keys (Iterable[str]): The keys of the files to fetch.
+        - workers (int): The number of concurrent downloads.
 
-        Returns:
-        - list[str]: A list of file keys for all files found in the specified folder.
+        Yields:
+        - Optional[list[bytes]]: The decompressed lines of each file, or None where decompression failed.
+        """
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(self.get_file_content, file_keys)
+
+
+    def stream_lines(self, file_key: str) -> Iterator[bytes]:
+        """
+        Streams the decompressed content of a specified file from S3 line by line.
+
+        The S3 body is read in 64 KiB chunks and fed through an incremental bz2
+        decompressor, carrying the partial line at the end of each chunk over to
+        the next one. Peak memory is therefore one chunk plus one line instead of
+        the whole decompressed file, and callers that only need the first line
+        (eg. to peek the market definition) never pull the rest of the body.
+
+        If the file cannot be decompressed, CorruptMarketFileError is raised so
+        the lines yielded before the failure cannot be mistaken for a complete
+        file; the caller should skip the file whole, matching the None return
+        of get_file_content. This might happen due to issues with the uploaded
+        files from Kishore's script.
+
+        Parameters:
+        - file_key (str): The key (path) of the file within the S3 bucket to fetch.
+
+        Yields:
+        - bytes: One line of the decompressed file content at a time.
+
+        Raises:
+        - CorruptMarketFileError: If the bz2 stream cannot be fully decompressed.
+        """
+
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=file_key)
+        decompressor = bz2.BZ2Decompressor()
+        buffer = b""
+
+        try:
+            for chunk in response['Body'].iter_chunks(64 * 1024):
+                buffer += decompressor.decompress(chunk)
+                *lines, buffer = buffer.split(b"\n")
+                yield from lines
+        except Exception as e:
+            # Ending the stream here would make a truncated file look complete,
+            # so the corruption is surfaced and the file skipped whole (this is
+            # a known issue from downloading data from Betfair)
+            raise CorruptMarketFileError(f"Error decompressing file: {file_key}") from e
+
+        # The incremental decompressor only raises on invalid data; a stream cut
+        # short before the end-of-stream marker ends quietly with eof unset, which
+        # the one-shot bz2.decompress would have reported as an error
+        if not decompressor.eof:
+            raise CorruptMarketFileError(f"Error decompressing file: {file_key}, compressed stream ended early")
+
+        if buffer:
+            yield buffer
+
+    def fetch_files_from_s3(self) -> Iterator[str]:
+        """
+        Yields the keys of all files located in the specified folder within the S3 bucket.
+
+        This method lists all files present in the initialized folder and yields their keys one page
+        at a time through boto3's paginator, which handles the continuation tokens and keeps the
+        listing lazy: the next page is only fetched once the current page has been consumed, so the
+        caller can apply backpressure instead of holding every key in memory up front.
+
+        Yields:
+        - str: The key of each file found in the specified folder.
 
         Example:
         - Input: None if the folder is empty (could be due to incorrect folder path))
         - Output: ["file1.bz2", "file2.bz2", ...]
         """
 
-        response: dict = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=self.folder)
-        all_files = []
-        
-        while True:
-            # Add the files from the current batch to the all_files list
-            all_files.extend(file['Key'] for file in response.get('Contents', []))
-            
-            # Check if the results are truncated, and if so, continue retrieving more
-            if response.get('IsTruncated'):
-                continuation_token = response.get('NextContinuationToken')
-                response = self.s3_client.list_objects_v2(Bucket=self.bucket, Prefix=self.folder, ContinuationToken=continuation_token)
-            else:
-                print(f"Total number of files retrieved from '{self.folder}': '{len(all_files)}'")
-                return all_files
\ No newline at end of file
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        total_files = 0
+
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.folder):
+            for file in page.get('Contents', []):
+                total_files += 1
+                yield file['Key']
+
+        print(f"Total number of files retrieved from '{self.folder}': '{total_files}'")
\ No newline at end of file
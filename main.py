@@ -1,74 +1,159 @@
 from exchange.orderbook import LadderBuilder
-from interface.s3 import S3
+from interface.s3 import S3, CorruptMarketFileError
 from interface.mongo import MongoDB, GridFs
 from exchange import betfair_utils
-from exchange.enums import MarketFilters, Sport, CountryFilters, Collections, Databases, MongoURIs, MetaBuilder
-import json
-import time
+from exchange.enums import MarketFilters, Sport, CountryFilters, Collections, Databases, MongoURIs, META_BUILDERS
+from exchange.metadata import MetadataBuilder
 import concurrent.futures
+import itertools
 import multiprocessing
-import threading
+import multiprocessing.util
+import os
 
 
-def run(s3: S3, mongodb: MongoDB, grid_fs: GridFs, file_key: str, market_filter: MarketFilters, meta_builder: MetaBuilder, country_filter: CountryFilters):
+# Per-process interface handles. The S3, MongoDB and GridFs clients hold live
+# sockets and cannot be pickled, so each worker process builds its own set once
+# via init_interfaces instead of receiving them from the parent process.
+s3_interface: S3 = None
+mongo_interface: MongoDB = None
+grid_fs_interface: GridFs = None
+
+
+def init_interfaces(folder: str, database: Databases, uri: MongoURIs):
+    """
+    Create the S3, MongoDB and GridFS interfaces for the current process.
+    Used directly in the sequential path and as the ProcessPoolExecutor
+    initializer in the multiprocess path, so every worker pays the
+    connection setup cost exactly once.
+    """
+
+    global s3_interface, mongo_interface, grid_fs_interface
+    s3_interface = S3(folder)
+    mongo_interface = MongoDB(database, uri)
+    grid_fs_interface = GridFs(mongo_interface.db, Collections.Marketdata)
+
+    # Upload whatever is left in the time series buffers when this process
+    # exits. atexit hooks never run in forked ProcessPoolExecutor workers
+    # (they leave through os._exit without interpreter shutdown), which would
+    # silently drop up to flush_at - 1 buffered documents per collection per
+    # worker. A multiprocessing finalizer covers both sides: Process._bootstrap
+    # runs finalizers in its finally block in every worker, and the parent runs
+    # them through multiprocessing's own atexit hook
+    multiprocessing.util.Finalize(None, mongo_interface.flush, exitpriority=10)
+
+
+def run(file_key: str, market_filter: MarketFilters, meta_builder: type[MetadataBuilder], country_filter: CountryFilters):
     """
     Run the pipeline for a single file retrieved from the specified folder in S3.
-    1. Check if the file is a market file and decompress it (from bz2 to string list)
-    2. JSON Load the market updates and extract the market definition from the market updates
-    3. Build ladders if market matches the market and country filters
-    4. Upload the marketdata to MongoDB (GridFS), Upload the metadata to MongoDB,
-    upload the ladders to MongoDB (TimeSeries) and upload the raw marketdata to MongoDB (TimeSeries)
+    1. Check if the file is a market file and stream its decompressed lines from S3
+    (bz2 is decompressed incrementally, never materializing the whole file)
+    2. Peek the market definition from the first update and check it against the market
+    and country filters, only JSON load the remaining market updates if the filters pass
+    3. Skip the file if its metadata was already uploaded in a previous session
+    4. Build ladders if market matches the market and country filters, streaming the
+    ladder and raw marketdata time series documents to the MongoDB buffers in batches
+    as they are produced
+    5. Upload the metadata to MongoDB
     """
 
     if not betfair_utils.is_market_file(file_key): return
-    market_string_updates: list[str] = s3.get_file_content(file_key)
-    if not market_string_updates: return
 
-    marketdata: list[dict] = betfair_utils.json_load_updates(market_string_updates)
-    market_definition: dict = betfair_utils.get_market_definition(marketdata)
+    # Files whose bz2 stream fails mid-way are skipped whole: the lines
+    # decompressed before the failure would otherwise build a partial market
+    # that uploads as if it were complete
+    try:
+        market_update_lines = s3_interface.stream_lines(file_key)
+        first_line: bytes = next(market_update_lines, None)
+        if not first_line: return
 
-    if not betfair_utils.is_matching_filters(market_definition, market_filter, country_filter): return
-    metadata, ladders, ts_marketdata = LadderBuilder(marketdata, market_definition, meta_builder).run()
+        market_definition: dict = betfair_utils.peek_market_definition(first_line)
+        if not betfair_utils.is_matching_filters(market_definition, market_filter, country_filter): return
 
-    # result_market = grid_fs.upload_file(marketdata, metadata)
-    result_meta = mongodb.insert_one(Collections.Metadata, metadata)
-    result_ladders = mongodb.insert_many(Collections.Ladders, ladders, result_meta, type="ts")
-    result_ts_marketdata = mongodb.insert_many(Collections.Marketdata, ts_marketdata, result_meta, type="ts")
+        # The time series documents are streamed to Mongo before the metadata insert
+        # could report a DuplicateKeyError, so duplicates have to be caught up front.
+        # The market id is the file name and the metadata _id is deterministic, which
+        # also means already-processed files now skip the replay entirely
+        market_id = file_key[file_key.rfind("/") + 1:].removesuffix(".bz2")
+        metadata_id = f"metadata_{market_id}_{market_definition['eventId']}"
+        if mongo_interface.find_one(Collections.Metadata, {"_id": metadata_id}, {"_id": 1}):
+            print(f"Duplicate Error: Skipping '{file_key}' because its metadata was already uploaded.")
+            return
 
-    print(f"Finished handling '{file_key} with thread id: {threading.current_thread().ident}'\n")
+        marketdata: list[dict] = betfair_utils.json_load_updates(itertools.chain([first_line], market_update_lines))
+    except CorruptMarketFileError as e:
+        print(e)
+        return
 
+    # The sinks hand each batch to the cross-file buffers, so at most one batch
+    # of ladder documents exists outside the buffers at any time. The time series
+    # uploads are unacknowledged (w=0): duplicates were already filtered above and
+    # time series collections have no unique indexes to violate
+    metadata, _, _ = LadderBuilder(marketdata, market_definition, meta_builder).run(
+        ts_sink=lambda batch: mongo_interface.buffer_insert(Collections.Ladders, batch, type="ts", w=0),
+        raw_sink=lambda batch: mongo_interface.buffer_insert(Collections.Marketdata, batch, type="ts", w=0)
+    )
+
+    # result_market = grid_fs_interface.upload_file(marketdata, metadata)
+    mongo_interface.insert_one(Collections.Metadata, metadata)
+
+    print(f"Finished handling '{file_key}' with process id: {os.getpid()}\n")
+
+
+def collect_results(futures):
+    """
+    Await the given futures so no worker failure goes unnoticed; a file
+    that errors shouldn't stop the remaining files from uploading.
+    """
+
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error while handling a market file: {e}")
 
-def main(folder: str, uri: MongoURIs, market_filter: MarketFilters, meta_builder: MetaBuilder, country_filter: CountryFilters, database: Databases, is_multiprocess: bool):
-    s3_interface = S3(folder)
-    mongo_interface = MongoDB(database, uri)
-    grid_fs_interface = GridFs(mongo_interface.db, Collections.Marketdata)
+
+def main(folder: str, uri: MongoURIs, market_filter: MarketFilters, meta_builder: type[MetadataBuilder], country_filter: CountryFilters, database: Databases, is_multiprocess: bool):
+    init_interfaces(folder, database, uri)
 
     if not is_multiprocess:
         for file_key in s3_interface.fetch_files_from_s3():
             run(
-                s3=s3_interface,
-                mongodb=mongo_interface,
-                grid_fs=grid_fs_interface,
                 file_key=file_key,
                 market_filter=market_filter,
                 meta_builder=meta_builder,
                 country_filter=country_filter
             )
     else:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as executor:
+        # run() is CPU-bound (JSON parse and ladder build) so threads would
+        # serialize on the GIL. Worker processes each get their own interfaces
+        # through the initializer and receive only picklable arguments.
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=multiprocessing.cpu_count(),
+            initializer=init_interfaces,
+            initargs=(folder, database, uri)
+        ) as executor:
+            # Cap in-flight work so peak memory scales with the worker count
+            # rather than the total number of S3 objects; the lazy key listing
+            # only fetches the next page once these submissions drain
+            max_pending = 2 * multiprocessing.cpu_count()
+            pending = set()
+
             for file_key in s3_interface.fetch_files_from_s3():
-                future = executor.submit(
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    collect_results(done)
+
+                pending.add(executor.submit(
                     run,
-                    s3=s3_interface,
-                    mongodb=mongo_interface,
-                    grid_fs=grid_fs_interface,
                     file_key=file_key,
                     market_filter=market_filter,
                     meta_builder=meta_builder,
                     country_filter=country_filter
-                )
+                ))
 
-            result = future.result()
+            collect_results(concurrent.futures.as_completed(pending))
     
 
 if __name__ == "__main__":
@@ -85,7 +170,7 @@ if __name__ == "__main__":
             folder,
             uri,
             MarketFilters.HorseRacingMarketRegex,
-            MetaBuilder.HorseRacing,
+            META_BUILDERS[sport],
             CountryFilters.HorseRacingCountryRegex,
             Databases.HorseRacing,
             is_multiprocess
@@ -95,7 +180,7 @@ if __name__ == "__main__":
             folder,
             uri,
             MarketFilters.FootballMarketRegex,
-            MetaBuilder.Football,
+            META_BUILDERS[sport],
             CountryFilters.FootballCountryRegex,
             Databases.Football,
             is_multiprocess
@@ -105,7 +190,7 @@ if __name__ == "__main__":
             folder,
             uri,
             MarketFilters.TennisMarketRegex,
-            MetaBuilder.Tennis,
+            META_BUILDERS[sport],
             CountryFilters.TennisCountryRegex,
             Databases.Tennis,
             is_multiprocess
@@ -3,49 +3,121 @@ from exchange.enums import MongoURIs, Databases, Collections
 from query_utils import MarketType
 
 mongo_client = MongoDB(Databases.HorseRacing, MongoURIs.Test)
-metadata_files = mongo_client.find(
-    collection = Collections.Metadata,
-    filter = {"marketDefinition.marketType": MarketType.WIN.value},
-    # projection = {"id": 1}
-)
-
-qualifying_count = 0
-matching_count = 0
-
-# Query directly into the individual ladder updates
-for metadata in metadata_files:
-    # Find random runner id
-    random_runner = str(metadata["marketDefinition"]["runners"][0]["id"])
-
-    # Get in-play start time from metadata
-    in_play_start_time = metadata["inPlayStartTime"]
-
-    # If race went in-play then it's a qualifying market
-    # Note, there are edge caes where the market never goes in-play
-    if in_play_start_time:
-        qualifying_count += 1
-
-    # Get the best back price and size 5 minutes before in-play for the random runner
-    best_back_5_minutes_before_in_play_price = metadata["pre5ladder"]["runners"][random_runner]["atb"][0][0]
-    best_back_5_minutes_before_in_play_size = metadata["pre5ladder"]["runners"][random_runner]["atb"][0][1]
-
-    # Set price threshold
-    price_threshold = best_back_5_minutes_before_in_play_price * 0.9
-
-    # Query for ladders that match the price threshold for the random runner
-    filtered_ladders = mongo_client.find_one(
-        collection = Collections.Ladders,
-        filter = {
-            # Match the market id
-            "marketId": metadata["id"],
-            # Only query in-play ladders
-            "pt": {"$gt": in_play_start_time},
-            # Filter the best back price for the random runner
-            f"runners.{random_runner}.atb.0.0": {"$lt": price_threshold},
-        },
-    )
-
-    if filtered_ladders:
-        matching_count += 1
-
-print(f"Matched {matching_count} out of {qualifying_count} qualifying markets. Total markets: {len(metadata_files)}")
\ No newline at end of file
+metadata_collection = mongo_client.db[Collections.Metadata.value]
+
+"""
+For every qualifying WIN market, check whether the best back price of a random
+runner ever dropped below 90% of its price 5 minutes before in-play. This used
+to loop over the metadata documents in Python and issue one find_one against
+the ladders collection per market (the classic N+1 pattern), so the runtime was
+one network round-trip per market. The whole question is now answered by a
+single server-side aggregation: the threshold is derived per market with
+$getField (the pre5ladder runners are keyed by runner id), the ladders are
+joined through a correlated $lookup that stops at the first matching document,
+and only the two counts come back over the wire.
+"""
+
+pipeline = [
+    # Stage 1: only WIN markets that actually went in-play qualify.
+    # Note, there are edge cases where the market never goes in-play
+    {
+        "$match": {
+            "marketDefinition.marketType": MarketType.WIN,
+            "inPlayStartTime": {"$ne": None},
+        }
+    },
+
+    # Stage 2: pick the random runner (first in the market definition) and read
+    # its best back price 5 minutes before in-play. The pre5ladder field holds
+    # the runners keyed by runner id, so the dynamic key is resolved with
+    # $getField; atb is a list of [price, size] pairs in descending price order
+    {
+        "$addFields": {
+            "randomRunnerId": {"$toString": {"$arrayElemAt": ["$marketDefinition.runners.id", 0]}},
+        }
+    },
+    {
+        "$addFields": {
+            "bestBack5Price": {
+                "$arrayElemAt": [
+                    {"$arrayElemAt": [
+                        {"$getField": {"field": "atb", "input": {"$getField": {"field": "$randomRunnerId", "input": "$pre5ladder"}}}},
+                        0
+                    ]},
+                    0
+                ]
+            },
+        }
+    },
+
+    # Stage 3: thin the documents down to the four fields the join needs before
+    # the $lookup, so the join never ingests the large pre-market ladders
+    {
+        "$project": {
+            "_id": 0,
+            "marketId": 1,
+            "inPlayStartTime": 1,
+            "randomRunnerId": 1,
+            "priceThreshold": {"$multiply": ["$bestBack5Price", 0.9]},
+        }
+    },
+
+    # Stage 4: correlated lookup into the ladders. Ladder documents carry the
+    # market id in their time series metaField ("metadata"), and the $limit 1
+    # makes MongoDB stop at the first in-play ladder below the threshold
+    {
+        "$lookup": {
+            "from": Collections.Ladders.value,
+            "let": {
+                "marketId": "$marketId",
+                "inPlayStartTime": "$inPlayStartTime",
+                "runnerId": "$randomRunnerId",
+                "priceThreshold": "$priceThreshold",
+            },
+            "pipeline": [
+                {
+                    "$match": {
+                        "$expr": {
+                            "$and": [
+                                # Match the market id
+                                {"$eq": ["$metadata", "$$marketId"]},
+                                # Only query in-play ladders
+                                {"$gt": ["$pt", "$$inPlayStartTime"]},
+                                # Filter the best back price for the random runner
+                                {
+                                    "$lt": [
+                                        {"$arrayElemAt": [
+                                            {"$arrayElemAt": [
+                                                {"$getField": {"field": "atb", "input": {"$getField": {"field": "$$runnerId", "input": "$runners"}}}},
+                                                0
+                                            ]},
+                                            0
+                                        ]},
+                                        "$$priceThreshold",
+                                    ]
+                                },
+                            ]
+                        }
+                    }
+                },
+                {"$limit": 1},
+                {"$project": {"_id": 1}},
+            ],
+            "as": "matchingLadders",
+        }
+    },
+
+    # Stage 5: count the qualifying markets and how many of them matched
+    {
+        "$group": {
+            "_id": None,
+            "qualifyingCount": {"$sum": 1},
+            "matchingCount": {"$sum": {"$cond": [{"$gt": [{"$size": "$matchingLadders"}, 0]}, 1, 0]}},
+        }
+    },
+]
+
+total_markets = metadata_collection.count_documents({"marketDefinition.marketType": MarketType.WIN})
+
+for doc in metadata_collection.aggregate(pipeline):
+    print(f"Matched {doc['matchingCount']} out of {doc['qualifyingCount']} qualifying markets. Total markets: {total_markets}")
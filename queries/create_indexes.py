@@ -0,0 +1,27 @@
+from interface.mongo import MongoDB
+from exchange.enums import MongoURIs, Databases, Collections
+
+"""
+One-off migration that creates the compound indexes the query scripts rely on.
+Without them every per-market lookup degenerates into a collection scan.
+
+- Ladders {metadata, pt}: the correlated $lookup in best_back_lay.py and
+  time_series.py matches the market id (stored in the time series metaField
+  "metadata") by equality and then ranges over pt, so the index is ordered
+  equality-then-range. The runner atb predicate is computed ($getField), so it
+  cannot be indexed and is filtered after the seek.
+- Metadata {marketDefinition.marketType, inPlayStartTime}: the initial $match
+  of both aggregations, again equality first.
+
+Run once per database; create_index is a no-op if the index already exists.
+"""
+
+mongo_client = MongoDB(Databases.HorseRacing, MongoURIs.Serverless)
+ladder_collection = mongo_client.db[Collections.Ladders.value]
+metadata_collection = mongo_client.db[Collections.Metadata.value]
+
+ladder_index = ladder_collection.create_index([("metadata", 1), ("pt", 1)])
+print(f"Created index '{ladder_index}' on '{Collections.Ladders.value}'.")
+
+metadata_index = metadata_collection.create_index([("marketDefinition.marketType", 1), ("inPlayStartTime", 1)])
+print(f"Created index '{metadata_index}' on '{Collections.Metadata.value}'.")
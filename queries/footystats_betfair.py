@@ -5,7 +5,7 @@ from sqlalchemy import create_engine
 import pandas as pd
 from query_utils import FootystatsToBetfair
 from query_utils import MarketType
-import json
+import orjson
 
 
 def create_sql_db_engine():
@@ -57,10 +57,14 @@ if __name__ == "__main__":
     df = execute_sql_query(sql_query, sql_connection)
 
     query = get_mongo_query(df)
-    metadata_files = mongo_client.find(
+
+    # Only one sample document is needed, so find_one avoids pulling the
+    # whole result set over the wire
+    sample_metadata = mongo_client.find_one(
         collection = Collections.Metadata,
         filter = query,
+        # The pre-market ladders dominate the document size and aren't part of
+        # this inspection, so they are projected out
+        projection = {"pre0ladder": 0, "pre5ladder": 0, "pre10ladder": 0},
     )
-
-    sample_metadata = metadata_files[0]
-    print(json.dumps(sample_metadata, indent=4, default=str))
+    print(orjson.dumps(sample_metadata, option=orjson.OPT_INDENT_2, default=str).decode())
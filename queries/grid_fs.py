@@ -1,20 +1,31 @@
-from interface.mongo import MongoDB, GridFs
+from interface.mongo import MongoDB
 from exchange.enums import MongoURIs, Databases, Collections
 from query_utils import MarketType
-import json
+import orjson
 
 
 mongo_client = MongoDB(Databases.Football, MongoURIs.Test)
-metadata_files = mongo_client.find(
+
+# Only one sample document is needed, so find_one avoids pulling the whole
+# result set over the wire
+sample_metadata = mongo_client.find_one(
     collection = Collections.Metadata,
-    filter = {"marketDefinition.marketType": MarketType.OVER_UNDER_25.value},
+    filter = {"marketDefinition.marketType": MarketType.OVER_UNDER_25},
+    projection = {"_id": 0, "marketId": 1},
 )
 
-gridfs_client = GridFs(mongo_client.db, Collections.Marketdata)
-
-sample_metadata = metadata_files[0]
-gridfs_id = gridfs_client.get_grid_fs_id(sample_metadata)
-sample_marketdata: dict = gridfs_client.retrieve_file_from_gridfs(gridfs_id)
+# The raw market data is stored one document per update in the Marketdata
+# time series collection (see LadderBuilder.set_raw_marketdata), so a single
+# update is fetched by position server-side instead of downloading the
+# market's whole GridFS dump only to index into it client-side
+sample_marketdata: dict = next(
+    mongo_client.find(
+        collection = Collections.Marketdata,
+        filter = {"metadata": sample_metadata["marketId"]},
+        projection = {"_id": 0},
+    ).sort("pt", 1).skip(111).limit(1),
+    None,
+)
 
 # Print sample update from raw market data
-print(json.dumps(sample_marketdata["marketData"][111], indent=4))
\ No newline at end of file
+print(orjson.dumps(sample_marketdata, option=orjson.OPT_INDENT_2, default=str).decode())
@@ -1,13 +1,20 @@
 from datetime import datetime
+from types import MappingProxyType
 import pandas as pd
 from enum import Enum
 
-BETFAIR_TO_FOOTYSTATS_MAPPING = {
+# Read-only view so call sites can't mutate the mapping table. Keys are the
+# Footystats team names, values the Betfair ones (lookups run Footystats to
+# Betfair despite the historical name)
+BETFAIR_TO_FOOTYSTATS_MAPPING = MappingProxyType({
     "Tottenham Hotspur": "Tottenham",
     "Aston Villa": "Aston Villa"
-}
+})
 
-class MarketType(Enum):
+# The str mixin makes each member a plain str as well, so call sites can use
+# MarketType.WIN directly in query filters (BSON and JSON encoders treat it as
+# its value) without the .value attribute hop
+class MarketType(str, Enum):
     WIN = "WIN"
     EACH_WAY = "EACH_WAY"
     MATCH_ODDS = "MATCH_ODDS"
@@ -15,24 +22,29 @@ class MarketType(Enum):
 
     def __str__(self):
         return self.value
-    
+
     def __repr__(self):
         return self.value
 
 class FootystatsToBetfair():
     def __init__(self, home_team: str, away_team: str, timestamp: pd.Timestamp, market_type: Enum) -> None:
         self.timestamp = timestamp
+        # Computed once here so repeated create_mongo_query calls on the same
+        # instance don't re-allocate the Timedelta
+        self.end_timestamp = timestamp + pd.Timedelta(days=1)
         self.market_type = market_type
-        betfair_home_team = BETFAIR_TO_FOOTYSTATS_MAPPING[home_team]
-        betfair_away_team = BETFAIR_TO_FOOTYSTATS_MAPPING[away_team]
+        # Teams missing from the mapping fall back to their Footystats name
+        # instead of raising, since most names already match Betfair's
+        betfair_home_team = BETFAIR_TO_FOOTYSTATS_MAPPING.get(home_team, home_team)
+        betfair_away_team = BETFAIR_TO_FOOTYSTATS_MAPPING.get(away_team, away_team)
         self.event_name = f"{betfair_home_team} v {betfair_away_team}"
 
 
     def create_mongo_query(self) -> dict:
         return {
             "marketDefinition.eventName": self.event_name,
-            "marketDefinition.marketType": self.market_type.value,
-            "marketDefinition.openDate": {"$gte": self.timestamp, "$lt": self.timestamp + pd.Timedelta(days=1)}
+            "marketDefinition.marketType": self.market_type,
+            "marketDefinition.openDate": {"$gte": self.timestamp, "$lt": self.end_timestamp}
         }
 
 
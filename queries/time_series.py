@@ -1,7 +1,6 @@
 from interface.mongo import MongoDB
 from exchange.enums import MongoURIs, Databases, Collections
 from query_utils import MarketType
-from bson.son import SON  # For ordered dictionary in projections
 
 mongo_client = MongoDB(Databases.HorseRacing, MongoURIs.Serverless)
 ladder_collection = mongo_client.db[Collections.Ladders.value]
@@ -9,89 +8,116 @@ metadata_collection = mongo_client.db[Collections.Metadata.value]
 
 """
 MongoDB can handle aggregation pipelines that are essentially a sequence of data processing operations (or query stages).
-The pipeline below tries to replicate the query in query-1.py, but in a single aggregation pipeline, without the need for
-storing intermediate results locally and iterating over them. Currently, the pipeline is broken, but at least shows the
-kind of operations and stages it can perform.
+The pipeline below replicates the query in best_back_lay.py in a single aggregation pipeline, without the need for storing
+intermediate results locally and iterating over them. MongoDB does not interpolate dotted paths like
+"$pre5ladder.$marketDefinition.runners.id.atb", so the runner-keyed sub-documents are resolved with $getField on a
+computed field name, and the correlated $lookup binds the per-market values through `let`.
+
+The stage order matters for throughput: metadata documents carry the full pre-market ladders (tens of KB each), so the
+pipeline projects down to the four fields the join needs immediately after the $match. The $lookup then only ever spools
+~100 byte documents instead of full metadata documents. The random runner is runners[0], so there is no $unwind either -
+unwinding before the projection multiplied every large document by the runner count just to discard the copies.
 """
 
 
 pipeline = [
-    # Stage 1: Filter for relevant markets
+    # Stage 1: Filter for relevant markets. inPlayStartTime is written as null
+    # when the market never goes in-play, and $exists matches null, so the
+    # filter has to be $ne None
     {
         "$match": {
-            "marketDefinition.marketType": "WIN", 
-            "inPlayStartTime": { "$exists": True } 
+            "marketDefinition.marketType": MarketType.WIN,
+            "inPlayStartTime": {"$ne": None}
         }
     },
 
-    # Stage 2: Unwind runners array
-    {
-        "$unwind": "$marketDefinition.runners"
-    },
-
-    # Stage 3: Project necessary data, pre-calculate values
+    # Stage 2: Project down to the four fields the join needs. The pre5ladder
+    # field holds the runners keyed by runner id string, so the random runner's
+    # (runners[0]) entry is resolved with $getField on the stringified id; atb
+    # is a list of [price, size] pairs, so two $arrayElemAt reach the best back
+    # price, and $let shares the runner id between the two computed fields
     {
         "$project": {
-            "_id": 0,  
-            "marketId": "$marketId",
-            "inPlayStartTime": "$inPlayStartTime",
-            "randomRunnerId": "$marketDefinition.runners.id",
-            "bestBack5Price": { 
-                "$arrayElemAt": [ "$pre5ladder.runners.$marketDefinition.runners.id.atb", 0] 
-            }, 
-            "priceThreshold": { 
-                "$multiply": [ 
-                    { "$arrayElemAt": [ "$pre5ladder.runners.$marketDefinition.runners.id.atb", 0] }, 
-                    0.9 
-                ] 
-            } 
+            "_id": 0,
+            "marketId": 1,
+            "inPlayStartTime": 1,
+            "runnerId": {"$toString": {"$arrayElemAt": ["$marketDefinition.runners.id", 0]}},
+            "priceThreshold": {
+                "$let": {
+                    "vars": {"runnerId": {"$toString": {"$arrayElemAt": ["$marketDefinition.runners.id", 0]}}},
+                    "in": {
+                        "$multiply": [
+                            {"$arrayElemAt": [
+                                {"$arrayElemAt": [
+                                    {"$getField": {"field": "atb", "input": {"$getField": {"field": "$$runnerId", "input": "$pre5ladder"}}}},
+                                    0
+                                ]},
+                                0
+                            ]},
+                            0.9
+                        ]
+                    }
+                }
+            }
         }
     },
 
-    # Stage 4: Lookup matching ladders
+    # Stage 3: Lookup matching ladders on the thin documents. Ladder documents
+    # carry the market id in their time series metaField ("metadata"); the
+    # $limit 1 lets MongoDB stop at the first in-play ladder below the
+    # threshold instead of collecting all of them
     {
         "$lookup": {
-            "from": "ladders",
-            "let": { 
-                "marketId": "$marketId", 
-                "inPlayStartTime": "$inPlayStartTime", 
-                "runnerId": "$randomRunnerId",
+            "from": Collections.Ladders.value,
+            "let": {
+                "marketId": "$marketId",
+                "inPlayStartTime": "$inPlayStartTime",
+                "runnerId": "$runnerId",
                 "priceThreshold": "$priceThreshold"
             },
             "pipeline": [
-                { 
+                {
                     "$match": {
                         "$expr": {
                             "$and": [
-                                { "$eq": [ "$metadata", "$$marketId" ] },
-                                { "$gt": [ "$pt", "$$inPlayStartTime" ] },
-                                { "$lt": [ "$runners.runnerId.atb.0.0", "$$priceThreshold" ] }
+                                {"$eq": ["$metadata", "$$marketId"]},
+                                {"$gt": ["$pt", "$$inPlayStartTime"]},
+                                {
+                                    "$lt": [
+                                        {"$arrayElemAt": [
+                                            {"$arrayElemAt": [
+                                                {"$getField": {"field": "atb", "input": {"$getField": {"field": "$$runnerId", "input": "$runners"}}}},
+                                                0
+                                            ]},
+                                            0
+                                        ]},
+                                        "$$priceThreshold"
+                                    ]
+                                }
                             ]
                         }
                     }
-                }
+                },
+                {"$limit": 1},
+                {"$project": {"_id": 1}}
             ],
             "as": "matchingLadders"
         }
     },
 
-    # Stage 5: Check if matching ladders were found
-    {
-        "$match": { "matchingLadders": { "$ne": [] } } 
-    },
-
-    # Stage 6: Count the final results
+    # Stage 4: Count the final results, matching only the markets whose lookup
+    # found at least one qualifying ladder
     {
         "$group": {
-            "_id": None, 
-            "qualifyingCount": { "$sum": 1 }, 
-            "matchingCount": { "$sum": 1 }
+            "_id": None,
+            "qualifyingCount": {"$sum": 1},
+            "matchingCount": {"$sum": {"$cond": [{"$gt": [{"$size": "$matchingLadders"}, 0]}, 1, 0]}}
         }
     }
 ]
 
 result = metadata_collection.aggregate(pipeline)
 
-# Print the results (assuming the aggregation yields a single document)
+# Print the results (the aggregation yields a single document)
 for doc in result:
-    print(f"Matched {doc['matchingCount']} out of {doc['qualifyingCount']} qualifying markets.") 
+    print(f"Matched {doc['matchingCount']} out of {doc['qualifyingCount']} qualifying markets.")